@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+ keys - time reading typed keys from curses
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage (in a terminal, as it needs curses): keys.py [keys]
+
+ Pushes keys (ascii and multibyte UTF-8 text) back into curses a few
+ at a time and reads them with get_char the way it was done before
+ (one getch per byte, checked by hand), with get_utf8_char and with
+ get_char (get_wch), and prints the time per key and wether they came
+ out right once curses is done.
+"""
+import curses
+import locale
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled.display import get_char, get_utf8_char
+
+# Bytes pushed back at once, curses keeps a small queue
+PUSHED = 64
+
+TEXT = 'for (x, y) in zip(a, b): print("{} → {}", x, y)  # señal 😀\n'
+
+
+def per_byte(win):
+    ''' get_char as it was '''
+    def get_check_next_byte():
+        c = win.getch()
+        if 128 <= c <= 191:
+            return c
+        else:
+            raise UnicodeError
+
+    bytes = []
+    c = win.getch()
+    if c < 32:
+        return c
+    elif c <= 127:
+        bytes.append(c)
+    elif 194 <= c <= 223:
+        bytes.append(c)
+        bytes.append(get_check_next_byte())
+    elif 224 <= c <= 239:
+        bytes.append(c)
+        bytes.append(get_check_next_byte())
+        bytes.append(get_check_next_byte())
+    elif 240 <= c <= 244:
+        bytes.append(c)
+        bytes.append(get_check_next_byte())
+        bytes.append(get_check_next_byte())
+        bytes.append(get_check_next_byte())
+    else:
+        return c
+    return str(''.join([chr(b) for b in bytes]))
+
+
+def expected(text):
+    return [ord(c) if c < ' ' else c for c in text]
+
+
+def bench(stdscr, count, results):
+    stdscr.timeout(0)
+    text = (TEXT * (count // len(TEXT) + 1))[:count]
+    # Split it in pieces of whole characters of at most PUSHED bytes
+    pieces = []
+    piece = b''
+    for c in text:
+        data = c.encode('utf-8')
+        if len(piece) + len(data) > PUSHED:
+            pieces.append(piece)
+            piece = b''
+        piece += data
+    pieces.append(piece)
+    for name, read in (('per byte', per_byte),
+                       ('decoder', get_utf8_char),
+                       ('get_wch', get_char)):
+        keys = []
+        elapsed = 0
+        for piece in pieces:
+            for b in reversed(piece):
+                curses.ungetch(b)
+            t0 = time.perf_counter()
+            while True:
+                key = read(stdscr)
+                if key == -1:
+                    break
+                keys.append(key)
+            elapsed += time.perf_counter() - t0
+        results.append('{:10} {:8} keys {:8.2f} us/key {}'.format(
+            name, count, elapsed * 1000000 / count,
+            'right' if keys == expected(text) else 'wrong'))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    results = []
+    locale.setlocale(locale.LC_ALL, '')
+    curses.wrapper(bench, count, results)
+    print('\n'.join(results))
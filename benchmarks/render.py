@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+ render - count the curses calls needed to draw a frame
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage (in a terminal, as it needs curses): render.py <file> [frames]
+
+ Draws the first screen of file, highlighted, from scratch a number of
+ times, both the way update_line did it before (one addstr per cell)
+ and with the run-length batched path, and prints the addstr calls and
+ time per frame once curses is done.
+"""
+import curses
+import locale
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled import Buffer, Display
+
+
+class CountingWindow:
+    ''' Forwards everything to a curses window, counting addstr calls '''
+    def __init__(self, win):
+        self.win = win
+        self.calls = 0
+
+    def addstr(self, *args):
+        self.calls += 1
+        return self.win.addstr(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.win, name)
+
+
+def per_cell(display, y, line, buf=None):
+    ''' update_line as it was: one encoded addstr per cell '''
+    r = display.row_width(y)
+    for i in range(r):
+        if i < (len(line) - 1):
+            a = line[i].attr
+            ch = line[i].ch
+        else:
+            ch = ' '
+            if (buf is not None) and (buf.high is not None):
+                a = buf.high.default_attribute()
+            else:
+                a = curses.A_NORMAL
+        display.stdscr.addstr(y, i, ch.encode('utf-8'), a)
+
+
+def frame(display, buf, draw):
+    for y in range(0, display.my - 1):
+        draw(y, buf[y + buf.viewport.y0], buf)
+    draw(display.my - 1, display.status)
+    display.stdscr.refresh()
+
+
+def bench(stdscr, path, frames, results):
+    display = Display(stdscr)
+    window = CountingWindow(stdscr)
+    display.stdscr = window
+    buf = Buffer(display.mx - 1, display.my - 2, display)
+    buf.open(path)
+    buf.highlight_viewport()
+    while buf.high.busy():
+        buf.high.pump()
+        time.sleep(0.01)
+    size = '{}x{}'.format(display.mx, display.my)
+
+    def batched(y, line, b=None):
+        display.canvas[y] = ['', []]    # Forget it, draw it all
+        display.update_line(y, line, b)
+
+    for name, draw in (('per cell', lambda y, l, b=None:
+                        per_cell(display, y, l, b)),
+                       ('batched', batched)):
+        window.calls = 0
+        t0 = time.perf_counter()
+        for i in range(frames):
+            frame(display, buf, draw)
+        elapsed = time.perf_counter() - t0
+        results.append('{:10} {} {:8.0f} calls/frame {:8.2f} ms/frame'.format(
+            name, size, window.calls / frames, elapsed * 1000 / frames))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: render.py <file> [frames]')
+        sys.exit(0)
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    results = []
+    locale.setlocale(locale.LC_ALL, '')
+    curses.wrapper(bench, sys.argv[1], frames, results)
+    print('\n'.join(results))
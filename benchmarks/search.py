@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+ search - time searching a file, and check what is found
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage: search.py <file> [searches]
+
+ Looks for some patterns forward from a number of places in file, both
+ line by line (as it was done before) and in the snapshot of Search,
+ and prints the time per search and wether both found the same. Empty
+ matches at the end of the buffer (as /^$ from the last line) are
+ checked too, they must not be found in a line after the last one.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled.search import Search, compile_pattern
+from pabled.storage import LineStore
+
+PATTERNS = [r'def \w+', r'return', r'^\s*$', r'o*', r'\w+$', r'zzz']
+
+
+class Lines:
+    ''' What Search looks at of a Buffer '''
+    def __init__(self, texts):
+        self.lines = LineStore(texts)
+        self.version = 0
+        self.index = None
+
+
+def per_line(lines, prog, y, x):
+    ''' Search forward a line at a time '''
+    for n in range(y, len(lines)):
+        text = lines.get_text(n)
+        match = prog.search(text, x if n == y else 0, len(text) - 1)
+        if match is not None:
+            return n, match.start()
+    return None, None
+
+
+def bench(texts, count):
+    buf = Lines(texts)
+    lines = buf.lines
+    search = Search(buf)
+    rnd = random.Random(0)
+    places = [(rnd.randrange(len(lines)), rnd.randint(0, 8))
+              for i in range(count)]
+    for pattern in PATTERNS:
+        prog = compile_pattern(pattern)
+        results = []
+        for name, find in (('per line', lambda y, x:
+                            per_line(lines, prog, y, x)),
+                           ('snapshot', lambda y, x:
+                            search.forward(prog, y, x))):
+            t0 = time.perf_counter()
+            found = [find(y, x) for y, x in places]
+            elapsed = time.perf_counter() - t0
+            results.append(found)
+            print('{:10} {:12} {:8} searches {:8.3f} ms/search'.format(
+                name, pattern, count, elapsed * 1000 / count))
+        print('{:10} {:12} {}'.format(
+            '', pattern, 'right' if results[0] == results[1] else 'wrong'))
+
+
+def check_end():
+    ''' Empty matches past the last newline are not found '''
+    buf = Lines(['foo\n', 'bar\n'])
+    search = Search(buf)
+    found = [search.forward(compile_pattern('^$'), 1, 0),
+             search.forward(compile_pattern('o*'), 1, 3)]
+    print('{:23} {}'.format('end of buffer',
+                            'right' if found == [(None, None), (1, 3)]
+                            else 'wrong'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: search.py <file> [searches]')
+        sys.exit(0)
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    bench(open(sys.argv[1]).readlines(), count)
+    check_end()
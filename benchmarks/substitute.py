@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+ substitute - time :%s/../../g runs with a million replacements
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage: substitute.py [lines]
+
+ Builds a LineStore of lines with five matches each (200000 lines by
+ default, a million replacements) and replaces them all, the way :s
+ used to (a search and a Line.replace() per match) and with
+ substitute_lines(), in this process and in a pool of processes.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled import LineStore, substitute_lines, substitute_parallel
+
+LINE = 'the foo jumps over foo, then foo and foo meet another foo here\n'
+
+
+def per_match(lines, prog, string):
+    ''' :s as it was: search from the start of the line, replace the
+        match, and again until there are no more '''
+    replacements = 0
+    for y in range(len(lines)):
+        line = lines[y]
+        while True:
+            match = prog.search(line.text)
+            if match is None:
+                break
+            line.replace(match.start(), match.end(), string)
+            replacements += 1
+    return replacements
+
+
+def bulk(lines, prog, string):
+    return substitute_lines(lines, prog, string, 0, len(lines), 0,
+                            workers=1)[0]
+
+
+def parallel(lines, prog, string):
+    return substitute_parallel(lines, prog, string, 0, len(lines), 0)[0]
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    prog = re.compile('foo')
+    for name, function in (('per match', per_match), ('bulk', bulk),
+                           ('parallel', parallel)):
+        lines = LineStore([LINE] * total)
+        t0 = time.perf_counter()
+        replacements = function(lines, prog, 'bar')
+        elapsed = time.perf_counter() - t0
+        assert lines.get_text(total - 1) == LINE.replace('foo', 'bar')
+        print('{:10} {:8d} replacements {:8.2f} s'.format(name, replacements,
+                                                         elapsed))
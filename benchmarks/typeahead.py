@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+ typeahead - time processing a burst of typed keys
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage (in a terminal, as it needs curses): typeahead.py <file> [keys]
+
+ Types a number of characters (and newlines) at the top of file, as a
+ paste would, both rehighlighting and painting after every key, as the
+ main loop did before, and in batches of TYPEAHEAD keys painted once,
+ and prints the time per key once curses is done.
+"""
+import curses
+import locale
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled import Buffer, Display, Keys
+from pabled.display import TYPEAHEAD
+from pabled.main import (set_command_mode_keys, set_insert_mode_keys,
+                         set_status_mode_keys)
+
+
+def typed(count):
+    ''' count keys of lines of python code '''
+    text = 'value = compute(value, "text")  # comment\n'
+    return [10 if c == '\n' else c for c in (text * count)[:count]]
+
+
+def bench(stdscr, path, count, results):
+    for name, batch in (('per key', 1), ('batched', TYPEAHEAD)):
+        display = Display(stdscr)
+        buf = Buffer(display.mx - 1, display.my - 2, display)
+        keys = Keys()
+        buf.open(path)
+        set_command_mode_keys(keys, buf)
+        set_status_mode_keys(keys, buf)
+        set_insert_mode_keys(keys, buf)
+        display.show(buf)
+        pending = typed(count)
+        keys.process('i', buf.mode)
+        t0 = time.perf_counter()
+        for i in range(0, count, batch):
+            if batch > 1:
+                buf.defer()
+            for key in pending[i:i + batch]:
+                keys.process(key, buf.mode)
+            buf.flush()
+            display.show(buf)
+        elapsed = time.perf_counter() - t0
+        results.append('{:10} {:8} keys {:8.3f} ms/key'.format(
+            name, count, elapsed * 1000 / count))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: typeahead.py <file> [keys]')
+        sys.exit(0)
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    results = []
+    locale.setlocale(locale.LC_ALL, '')
+    curses.wrapper(bench, sys.argv[1], count, results)
+    print('\n'.join(results))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+ write - throughput of saving a buffer
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage: write.py <file> [output]
+
+ Loads file in a LineStore and saves it to output (a temporary file by
+ default) one character at a time, as :w used to, and with
+ storage.write_file(), printing the throughput of both.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled import LineStore, write_file
+
+
+def per_char(lines, path):
+    ''' :w as it was, a write() per character of every Line '''
+    with open(path, 'w') as f:
+        for l in lines:
+            for char in l:
+                if not (char.ch == '\n' and l.noeol):
+                    f.write(char.ch)
+
+
+def bench(name, function, lines, path, size):
+    t0 = time.perf_counter()
+    function(lines, path)
+    elapsed = time.perf_counter() - t0
+    print('{:10} {:8.2f} s {:8.1f} MB/s'.format(name, elapsed,
+                                              size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: write.py <file> [output]')
+        sys.exit(0)
+    directory = None
+    if len(sys.argv) > 2:
+        output = sys.argv[2]
+    else:
+        directory = tempfile.mkdtemp()
+        output = os.path.join(directory, 'out')
+    size = os.path.getsize(sys.argv[1])
+    with open(sys.argv[1]) as f:
+        lines = LineStore(f.readlines())
+    # Both from Line objects, as after editing
+    for line in lines:
+        pass
+    bench('per char', per_char, lines, output, size)
+    bench('buffered', write_file, lines, output, size)
+    os.unlink(output)
+    if directory is not None:
+        os.rmdir(directory)
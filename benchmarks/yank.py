@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+ yank - time yanking and pasting a hundred thousand lines
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ Usage: yank.py [lines]
+
+ Yanks all the lines of a LineStore (100000 by default, already
+ turned into Line objects) and pastes them at its end, the way :y and
+ p used to (keeping the Line objects and pasting a deepcopy of them)
+ and through Registers.
+"""
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pabled import LineStore, Line, Registers
+
+LINE = 'yanked and pasted, and yanked and pasted again, all day long\n'
+
+
+def deepcopy(lines):
+    yankring = [lines[n] for n in range(len(lines))]
+    lines.insert_many(len(lines), copy.deepcopy(yankring))
+
+
+def registers(lines):
+    r = Registers()
+    r.store(r.take(), lines.texts(0, len(lines)))
+    lines.insert_many(len(lines), r.get(r.take()))
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, function in (('deepcopy', deepcopy), ('registers', registers)):
+        lines = LineStore([Line(LINE) for n in range(total)])
+        t0 = time.perf_counter()
+        function(lines)
+        elapsed = time.perf_counter() - t0
+        assert len(lines) == 2 * total
+        assert lines.get_text(2 * total - 1) == LINE
+        print('{:10} {:8d} lines {:8.3f} s'.format(name, total, elapsed))
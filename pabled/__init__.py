@@ -1,9 +1,17 @@
 __all__ = ["buffer", "display", "statusline", "ex", "line", "highlight",
-           "keys", "game2048"]
+           "keys", "game2048", "storage", "search", "trigram",
+           "substitute", "undo", "registers"]
 from .game2048 import game_2048  # noqa
 from .ex import Ex  # noqa
 from .line import (Cursor, Viewport, Line, Char, insert_element,  # noqa
                    delete_element)  # noqa
+from .storage import (LineStore, MappedFile, Indexer,  # noqa
+                      write_file)  # noqa
+from .search import Search, compile_pattern  # noqa
+from .trigram import TrigramIndex  # noqa
+from .substitute import substitute_lines, substitute_parallel  # noqa
+from .undo import Journal  # noqa
+from .registers import Registers  # noqa
 from .display import Display  # noqa
 from .status import StatusLine  # noqa
 from .highlight import Highlighter  # noqa
@@ -18,9 +18,20 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import curses
+import os
 import re
 from pabled import (Ex, StatusLine, Cursor, Viewport, Line, Highlighter,
-                    Char, Visual, insert_element, delete_element)
+                    Char, Visual, LineStore, MappedFile, Indexer, Search,
+                    TrigramIndex, Journal, compile_pattern, insert_element,
+                    delete_element)
+from pabled.trigram import INDEX_LINES
+
+# Files bigger than this are not read, but mapped in memory and decoded
+# line by line when needed
+MAP_BYTES = 32 * 1024 * 1024
+# Of those, the lines in the first FIRST_BYTES are found right away, so
+# the first screen can be shown, and the rest in the background
+FIRST_BYTES = 1024 * 1024
 
 
 class Buffer(Ex, StatusLine, Visual):
@@ -32,7 +43,7 @@ class Buffer(Ex, StatusLine, Visual):
         # Call inherited from classes one by one ...
         Ex.__init__(self)
         Visual.__init__(self)
-        self.lines = []
+        self.lines = LineStore()
         self.cursor = Cursor()
         self.viewport = Viewport(x1, y1)
         self.height = y1
@@ -40,25 +51,111 @@ class Buffer(Ex, StatusLine, Visual):
         self.mode = self.COMMAND
         self.display = display
         self.regexp = None
+        self.reprog = None
+        # Wether to show the matches of the last search (see :noh)
+        self.hlsearch = False
+        self.searcher = Search(self)
+        # Narrows searches in big buffers, see TrigramIndex
+        self.index = None
         self.path = ''
+        # Finding the lines of a mapped file, see load()
+        self.indexer = None
+        # Incremented on every change, see rescan()
+        self.version = 0
+        # Changes to undo and redo
+        self.journal = Journal(self)
+        # Lines to rehighlight when a batch of keys is over, see defer()
+        self.batch = None
+        self.dirty = None
 
         self.visualrange = None
         self.display = display      # Currently associated
 
     def open(self, path):
-        self.lines = []
-        for l in open(path).readlines():
-            # l[:-1]
-            line = Line(l)
-            # .decode('utf-8'))
-            self.lines.append(line)
-
-        self.high = Highlighter(self)
-        self.high.scan(0, len(self.lines))
+        # Lines are kept as read, and turned into Line objects
+        # by the LineStore only when accessed
+        lazy = None
+        if os.path.getsize(path) > MAP_BYTES:
+            source = MappedFile(path, FIRST_BYTES)
+            self.lines = LineStore(source=source)
+            self.indexer = Indexer(source, FIRST_BYTES)
+            self.display.print_in_statusline(20, '[indexing]', 20)
+            lazy = True
+        else:
+            self.lines = LineStore(open(path).readlines())
         self.path = path
+        if self.indexer is not None or len(self.lines) > INDEX_LINES:
+            self.index = TrigramIndex(self)
+        # Lines in the viewport are highlighted when displayed, and
+        # the rest by the background worker (unless lazy)
+        self.high = Highlighter(self, lazy)
+
+    def loading(self):
+        ''' Wether lines of the file are still being found '''
+        return self.indexer is not None
+
+    def load(self, wait=False):
+        ''' Add the lines of the file found in the background so far
+            (or wait for all of them). Return True if there were any '''
+        if self.indexer is None:
+            return False
+        first = len(self.lines.source)
+        if not self.indexer.pump(wait):
+            return False
+        self.lines.grow(first)
+        if self.indexer.done():
+            self.indexer = None
+            message = ''
+        else:
+            message = '[indexing {}%]'.format(self.indexer.progress())
+        if self.mode != self.STATUS:
+            self.display.print_in_statusline(20, message, 20)
+        return True
+
+    def rescan(self, since=0, to=None):
+        ''' Rehighlight after the lines from since up to (not
+            including) to were changed, inserted or deleted '''
+        self.version += 1
+        self.lines.invalidate(since, len(self.lines) if to is None else to)
+        if self.high is None:
+            return
+        if self.batch is not None:
+            # Rehighlighted once in flush(), None meaning to the end.
+            # Once lines were inserted or deleted, the lines changed
+            # before may have moved anywhere after since
+            if len(self.lines) != self.batch:
+                to = None
+            if self.dirty is not None:
+                since = min(since, self.dirty[0])
+                if to is not None and self.dirty[1] is not None:
+                    to = max(to, self.dirty[1])
+                else:
+                    to = None
+            self.dirty = [since, to]
+            return
+        if to is None:
+            to = len(self.lines)
+        self.high.update(since, to)
+
+    def defer(self):
+        ''' Keep the changes made from now on to rehighlight them all at
+            once in flush(), when a batch of keys typed ahead is over '''
+        # The number of lines, to tell if it changed
+        self.batch = len(self.lines)
+
+    def flush(self):
+        ''' Rehighlight what changed since defer() '''
+        self.batch = None
+        if self.dirty is None:
+            return
+        since, to = self.dirty
+        self.dirty = None
+        self.high.update(since, len(self.lines) if to is None else to)
 
-    def rescan(self):
-        self.high.scan(0, len(self.lines))
+    def highlight_viewport(self):
+        ''' Highlight the lines in the viewport, if not done yet '''
+        if self.high is not None:
+            self.high.ensure(self.viewport.y0, self.viewport.y1)
 
     def __getitem__(self, n):
         try:
@@ -85,6 +182,9 @@ class Buffer(Ex, StatusLine, Visual):
         # If we are beyond the last line, move to the last line
         if c.cursor.y > (len(c.lines) - 1):
             c.cursor.y = len(c.lines) - 1
+        # Or before the first one (after deleting it)
+        if c.cursor.y < 0:
+            c.cursor.y = 0
         li = c.current_line().last_index(c.mode)
         if li == -1:
             c.cursor.x = 0
@@ -119,87 +219,102 @@ class Buffer(Ex, StatusLine, Visual):
         c.__cursor_adjustement()
         c.__viewport_adjustement()
 
-    def cursor_up(c, k):
+    def cursor_up(c, k, count=None):
         if not c.cursor.y == 0:
-            c.cursor.y -= 1
+            c.cursor.y = max(c.cursor.y - (count or 1), 0)
             c.cursor_and_viewport_adjustement()
 
-    def cursor_down(c, k):
+    def cursor_down(c, k, count=None):
         if (c.length() - 1) > c.cursor.y:
-            c.cursor.y += 1
+            c.cursor.y = min(c.cursor.y + (count or 1), c.length() - 1)
             c.cursor_and_viewport_adjustement()
 
+    def goto_line(c, k, count=None):
+        ''' Go to line count, or to the last one (G) '''
+        if count is None:
+            count = c.length()
+        c.cursor.y = max(min(count, c.length()) - 1, 0)
+        c.cursor_and_viewport_adjustement()
+        c.move_to_first_non_blank(k)
+
     def __cursor_max_reset(c):
         """ Any deliberate movement left or right should reset the max """
         c.cursor.max = c.cursor.x
 
-    def cursor_left(c, k):
-        if not c.cursor.x == 0:
-            # Jump over indentation
-            x = c.cursor.x
-            if (x >= 4) and ((x % 4) == 0):
+    def cursor_left(c, k, count=None):
+        for i in range(count or 1):
+            if not c.cursor.x == 0:
+                # Jump over indentation
+                x = c.cursor.x
+                if (x >= 4) and ((x % 4) == 0):
+                    line = c.current_line()
+                    for si in range(x - 4, x - 1):
+                        if line[si].ch != ' ':
+                            break
+                    else:
+                        c.cursor.x -= 3  # Last one is default
+                c.cursor.x -= 1
+                c.__cursor_max_reset()
+                c.cursor_and_viewport_adjustement()
+
+    def cursor_right(c, k, count=None):
+        for i in range(count or 1):
+            if (c.current_line().last_index(c.mode) > (c.cursor.x -
+                                                       c.viewport.x0)):
+                # Jump over indentation
+                x = c.cursor.x
                 line = c.current_line()
-                for si in range(x - 4, x - 1):
-                    if line[si].ch != ' ':
-                        break
-                else:
-                    c.cursor.x -= 3  # Last one is default
-            c.cursor.x -= 1
-            c.__cursor_max_reset()
-            c.cursor_and_viewport_adjustement()
-
-    def cursor_right(c, k):
-        if (c.current_line().last_index(c.mode) > (c.cursor.x -
-                                                   c.viewport.x0)):
-            # Jump over indentation
-            x = c.cursor.x
-            line = c.current_line()
-            if len(line) > (x + 4):
-                for si in range(x, x + 4):
-                    if line[si].ch != ' ':
-                        break
-                else:
-                    c.cursor.x += 3  # Last one is default
-            c.cursor.x = c.cursor.x + 1
-            c.__cursor_max_reset()
-            c.cursor_and_viewport_adjustement()
+                if len(line) > (x + 4):
+                    for si in range(x, x + 4):
+                        if line[si].ch != ' ':
+                            break
+                    else:
+                        c.cursor.x += 3  # Last one is default
+                c.cursor.x = c.cursor.x + 1
+                c.__cursor_max_reset()
+                c.cursor_and_viewport_adjustement()
 
     def extract_text(self, since, to):
-        """ Return a dictionary with the addresses passed and
-            a raw buffer "text" from a range of lines
+        """ Return a dictionary with the addresses passed,
+            a raw buffer "text" from a range of lines and "refs",
+            the position in text where each line starts
             This text can be modified by a external function
             and reinserted with insert_text in place
         """
-        t = ''
-        refs = {}
+        strings = []
+        refs = []
         index = 0
         for n in range(since, to):
-            string, index = self.lines[n].get_string_and_refs(refs, index)
-            t += string
-        return {'since': since, 'to': to, 'text': t, 'refs': refs}
-        # +1 for the \n so both text and attributes have same length
-
-    def page_forward(self, key):
+            string = self.lines.get_text(n)
+            refs.append(index)
+            strings.append(string)
+            index += len(string)
+        return {'since': since, 'to': to, 'text': ''.join(strings),
+                'refs': refs}
+
+    def page_forward(self, key, count=None):
         ''' Avpag and move cursor vi-alike '''
-        delta = self.height - 1
-        if ((self.viewport.y0 + delta) > len(self.lines)):
-            delta = (len(self.lines) - self.viewport.y0 - 1)
-        self.viewport.y0 += delta
-        self.viewport.y1 += delta
-        self.cursor.y = self.viewport.y0
-        self.cursor_and_viewport_adjustement()
-
-    def page_backwards(self, key):
-        delta = self.height - 1
-        if ((self.viewport.y0 - delta) < 0):
-            delta = self.viewport.y0
-        self.viewport.y0 -= delta
-        self.viewport.y1 -= delta
-        if (self.viewport.y1 > (len(self.lines) - 1)):
-            self.cursor.y = len(self.lines) - 1
-        else:
-            self.cursor.y = self.viewport.y1
-        self.cursor_and_viewport_adjustement()
+        for i in range(count or 1):
+            delta = self.height - 1
+            if ((self.viewport.y0 + delta) > len(self.lines)):
+                delta = (len(self.lines) - self.viewport.y0 - 1)
+            self.viewport.y0 += delta
+            self.viewport.y1 += delta
+            self.cursor.y = self.viewport.y0
+            self.cursor_and_viewport_adjustement()
+
+    def page_backwards(self, key, count=None):
+        for i in range(count or 1):
+            delta = self.height - 1
+            if ((self.viewport.y0 - delta) < 0):
+                delta = self.viewport.y0
+            self.viewport.y0 -= delta
+            self.viewport.y1 -= delta
+            if (self.viewport.y1 > (len(self.lines) - 1)):
+                self.cursor.y = len(self.lines) - 1
+            else:
+                self.cursor.y = self.viewport.y1
+            self.cursor_and_viewport_adjustement()
 
     def cursor_to_eol(self, key):
         ''' Move Cursor to End-of-Line '''
@@ -233,9 +348,11 @@ class Buffer(Ex, StatusLine, Visual):
         elif self.mode == self.INSERT:
             self.mode = self.COMMAND
             self.display.print_in_statusline(0, '-- COMMAND --', 20)
-            # Adjust cursor if it is over the '\n'
+            # Adjust cursor if it is over the '\n' (but not before the
+            # start of an empty line)
             if self.cursor.x > self.current_line().last_index(self.mode):
-                self.cursor.x = self.current_line().last_index(self.mode)
+                self.cursor.x = max(self.current_line().last_index(self.mode),
+                                    0)
 
     def append(self, key):
         # Supposedly we are in COMMAND mode when this is run, so
@@ -246,17 +363,34 @@ class Buffer(Ex, StatusLine, Visual):
         ch = key.encode('utf-8')
         self.display.print_in_statusline(40, '[{}]'.format(ch), 10)
         index = self.cursor.x
-        insert_element(self.lines[self.cursor.y], index,
-                       Char(key, curses.A_NORMAL))
+        line = self.lines[self.cursor.y]
+        # Where it goes, as in a slice
+        at = slice(index, None).indices(len(line))[0]
+        insert_element(line, index, Char(key, curses.A_NORMAL))
+        self.journal.span(self.cursor.y, at, '', key)
         self.cursor_right('@')
-        self.rescan()
+        self.rescan(self.cursor.y, self.cursor.y + 1)
         self.cursor_and_viewport_adjustement()
 
-    def delete_char_at_cursor(self, key):
+    def delete_char_at_cursor(self, key, count=None):
         index = self.cursor.x
         l = len(self.current_line())
+        if count is not None and l > 1:
+            # Up to count characters of this line, as vi does
+            at = slice(index, None).indices(l - 1)[0]
+            n = min(count, l - 1 - at)
+            if n > 0:
+                old = self.current_line().text[at:at + n]
+                self.lines[self.cursor.y].splice(at, at + n, '')
+                self.journal.span(self.cursor.y, at, old, '')
+                self.rescan(self.cursor.y, self.cursor.y + 1)
+                self.cursor_and_viewport_adjustement()
+            return
         if l == 1:
+            old = self.journal.texts(self.cursor.y, self.cursor.y + 1)
             del self.lines[self.cursor.y]
+            self.journal.lines(self.cursor.y, old, 0)
+            self.rescan(self.cursor.y, self.cursor.y)
             # self.cursor_down(key)
         elif index == (l - 1):
             self.delete_char_before_cursor(key)
@@ -271,44 +405,113 @@ class Buffer(Ex, StatusLine, Visual):
                         # Delete the four spaces
                         for di in range(4):
                             delete_element(self.lines[self.cursor.y], index)
+                        self.journal.span(self.cursor.y, index, '    ', '')
+                        self.rescan(self.cursor.y, self.cursor.y + 1)
                         return
+            at = slice(index, None).indices(l)[0]
+            ch = self.current_line().text[at:at + 1]
             delete_element(self.lines[self.cursor.y], index)
-
-    def delete_char_before_cursor(self, key):
-        x = self.cursor.x
-        if x == 0:
-            # If we are in the first character, move up and join
-            y = self.cursor.y
-            if y == 0:
-                return
-            self.cursor_up(key)
-            # I would prefer to use join(), but join trims
-            y = self.cursor.y
-            self.cursor_to_eol(key)
-            self.lines[y].add(self.lines[y + 1], False)
-            del self.lines[y + 1]
-            return
-        self.cursor_left(key)
-        self.delete_char_at_cursor(key)
-
-    def join(self, key):
+            if ch:
+                self.journal.span(self.cursor.y, at, ch, '')
+            self.rescan(self.cursor.y, self.cursor.y + 1)
+
+    def delete_char_before_cursor(self, key, count=None):
+        for i in range(count or 1):
+            x = self.cursor.x
+            if x == 0:
+                # If we are in the first character, move up and join
+                y = self.cursor.y
+                if y == 0:
+                    return
+                self.cursor_up(key)
+                # I would prefer to use join(), but join trims
+                y = self.cursor.y
+                self.cursor_to_eol(key)
+                old = self.journal.texts(y, y + 2)
+                self.lines[y].add(self.lines[y + 1], False)
+                del self.lines[y + 1]
+                self.journal.lines(y, old, 1)
+                self.rescan(y, y + 1)
+                continue
+            self.cursor_left(key)
+            self.delete_char_at_cursor(key)
+
+    def join(self, key, count=None):
+        ''' Join count lines (two at least) from the cursor on. Leading
+            blanks of the lines joined become a single space, and empty
+            lines go away '''
         # Join has many inconsistences; what happens when you join
         # in an empty line? what happens when you join an empty line?
         y = self.cursor.y
+        end = min(y + max(count or 2, 2), len(self.lines))
+        if end - y < 2:
+            return
         # Move to eol if not already there
         self.cursor_to_eol(key)
-        self.lines[y].add(self.lines[y + 1], True)
-        del self.lines[y + 1]
+        old = self.journal.texts(y, end)
+        text = old[0].rstrip('\n')
+        eol = old[0].endswith('\n')
+        for other in old[1:]:
+            if other.rstrip('\n') == '':
+                continue
+            text += ' ' + other.rstrip('\n').lstrip(' \t')
+            eol = other.endswith('\n')
+        self.replace_lines(y, old, [text + '\n' if eol else text])
 
     def enter(self, key):
         y = self.cursor.y
+        old = self.journal.texts(y, y + 1)
         new_line = self.lines[y].split(self.cursor.x)
-        self.lines = self.lines[:(y + 1)] + [new_line] + self.lines[(y + 1):]
+        self.lines.insert(y + 1, new_line)
+        self.journal.lines(y, old, 2)
+        self.rescan(y, y + 2)
         self.cursor.x = 0
         self.cursor.max = 0
         self.cursor.y += 1
         self.cursor_and_viewport_adjustement()
 
+    def insert_text(self, key):
+        ''' Insert the text of a Paste at the cursor, in any mode, as a
+            single change of the lines it spans, and leave the cursor
+            after it '''
+        if key.text == '':
+            return
+        pieces = key.text.split('\n')
+        y = min(self.cursor.y, len(self.lines))
+        if y < len(self.lines):
+            old = self.journal.texts(y, y + 1)
+            text = old[0]
+        else:
+            old = []
+            text = '\n'
+        # The last line of the file may have no newline, and keeps it so
+        eol = text.endswith('\n')
+        if eol:
+            text = text[:-1]
+        at = min(max(self.cursor.x, 0), len(text))
+        if len(pieces) == 1 and old:
+            self.lines[y].splice(at, at, key.text)
+            self.journal.span(y, at, '', key.text)
+            self.rescan(y, y + 1)
+        else:
+            text = text[:at] + key.text + text[at:]
+            new = [piece + '\n' for piece in text.split('\n')]
+            if not eol:
+                new[-1] = new[-1][:-1]
+            del self.lines[y:y + len(old)]
+            self.lines.insert_many(y, new)
+            self.journal.lines(y, old, len(new))
+            self.rescan(y, None)
+            at = 0
+        self.cursor.y = y + len(pieces) - 1
+        self.cursor.x = at + len(pieces[-1])
+        if self.mode == self.COMMAND:
+            self.cursor.x = max(min(self.cursor.x,
+                                    self.current_line().last_index(self.mode)),
+                                0)
+        self.cursor.max = self.cursor.x
+        self.cursor_and_viewport_adjustement()
+
     def tab(self, key):
         # Move to the next tab stop
         x = self.cursor.x
@@ -317,35 +520,46 @@ class Buffer(Ex, StatusLine, Visual):
             self.insert_char(' ')
 
     def search(self, pattern=None, reverse=False):
-        y = self.cursor.y
-        x = self.cursor.x
-        if reverse:
-            ran = reversed(list(range(0, y - 1)))
-        else:
-            ran = list(range(y, len(self.lines)))
-        first = True
-        for i in ran:
-            if first:
-                x = self.cursor.x + 1  # Use cursor on first line to search
-                first = False
-            else:
-                x = 0
-            if pattern is None and self.regexp is None:
+        if pattern is None:
+            if self.regexp is None:
                 self.display.print_in_statusline(0, '-- No regexp --', 20)
                 return
-            elif pattern is None and self.regexp is not None:
-                pattern = self.regexp
-            else:
-                self.regexp = pattern
-            start, end = self.find(i, x, pattern)
-            if start is not None:
-                self.display.print_in_statusline(0, '/' + pattern, 20)
-                self.cursor.x = start
-                self.cursor.y = i
-                self.cursor_and_viewport_adjustement()
-                return
-        message = '-- {} Not found --'.format(pattern)
-        self.display.print_in_statusline(0, message, 40)
+            pattern = self.regexp
+        try:
+            # Regexp is global to all (search/replace/etc) commands
+            self.reprog = compile_pattern(pattern)
+        except re.error:
+            message = '-- Bad regexp {} --'.format(pattern)
+            self.display.print_in_statusline(0, message, 40)
+            return
+        self.regexp = pattern
+        self.hlsearch = True
+        if reverse:
+            y, x = self.searcher.backward(self.reprog, self.cursor.y,
+                                          self.cursor.x)
+        else:
+            y, x = self.searcher.forward(self.reprog, self.cursor.y,
+                                         self.cursor.x + 1)
+        if y is None:
+            message = '-- {} Not found --'.format(pattern)
+            self.display.print_in_statusline(0, message, 40)
+            return
+        self.display.print_in_statusline(0, ('?' if reverse else '/') +
+                                         pattern, 20)
+        self.cursor.x = x
+        self.cursor.y = y
+        self.cursor_and_viewport_adjustement()
+
+    def search_spans(self):
+        ''' Spans of the matches of the last search in the lines of the
+            viewport, by line (see Search.spans) '''
+        if not self.hlsearch or self.regexp is None:
+            return {}
+        try:
+            prog = compile_pattern(self.regexp)
+        except re.error:
+            return {}
+        return self.searcher.spans(prog, self.viewport.y0, self.viewport.y1)
 
     def find(self, index, x, pattern=None):
         if pattern is None:
@@ -353,20 +567,20 @@ class Buffer(Ex, StatusLine, Visual):
                 return None, None
         else:
             # Regexp is global to all (search/replace/etc) commands
-            self.reprog = re.compile(pattern)
-        emptyrefs = {}
-        string, refs = self.lines[index].get_string_and_refs(emptyrefs, 0)
-        haystack = string[x:]
+            self.reprog = compile_pattern(pattern)
+        haystack = self.lines.get_text(index)[x:]
         match = self.reprog.search(haystack)
         if match is None:
             return None, None
         return (match.start() + x), (match.end() + x)
 
-    def repeat_find_forward(self, key):
-        self.search()
+    def repeat_find_forward(self, key, count=None):
+        for i in range(count or 1):
+            self.search()
 
-    def repeat_find_backward(self, key):
-        self.search(reverse=True)
+    def repeat_find_backward(self, key, count=None):
+        for i in range(count or 1):
+            self.search(reverse=True)
 
     def error(self, key):
         pass
@@ -377,12 +591,28 @@ class Buffer(Ex, StatusLine, Visual):
             mode refers implicitily to the lines addressed '''
         self.set_visual()
 
-    def delete_line(self, key):
-        ''' delete the line the cursor is in '''
-        del self.lines[self.cursor.y]
+    def delete_line(self, key, count=None):
+        ''' delete the line the cursor is in, and the next ones up to
+            count lines '''
+        y = self.cursor.y
+        end = min(y + (count or 1), len(self.lines))
+        self.registers.store(self.registers.take(), self.lines.texts(y, end))
+        self.replace_lines(y, self.journal.texts(y, end), [])
         self.cursor_and_viewport_adjustement()
         self.move_to_first_non_blank(key)
 
+    def replace_lines(self, y, old, texts):
+        ''' Replace the lines from y on with the texts in old (see
+            Journal.texts) with texts, all at once '''
+        del self.lines[y:y + len(old)]
+        self.lines.insert_many(y, texts)
+        self.journal.lines(y, old, len(texts))
+        self.rescan(y, y + len(texts))
+
+    def select_register(self, key):
+        ''' "x, use register x in the next yank, delete or paste '''
+        self.registers.select(key)
+
     def move_to_first_non_blank(self, key):
         ''' Move to the first non-blank character on line (^) '''
         line = self.current_line()
@@ -396,53 +626,44 @@ class Buffer(Ex, StatusLine, Visual):
         self.cursor.x = mx
         self.cursor.max = mx
 
-    def shift(self, right=True):
-        ''' Shift right/left n spaces (tab size) or a tab character '''
-        # ch = ' '.encode('utf-8')
-        x = 0
+    def shift(self, right=True, count=None):
+        ''' Shift right/left n spaces (tab size) or a tab character the
+            lines selected, or count lines from the cursor on '''
         if self.visual_cursor is not None:
             first_line, last_line = self.get_visual_range()
-            r = list(range(first_line, last_line + 1))
             # Reset visual selection
             self.set_visual()
         else:
-            r = [self.cursor.y]
-        if right:
-            for y in r:
-                line = self.lines[y]
-                if len(line) == 0:
-                    continue        # Do not shift empty lines
-                for times in range(4):
-                    insert_element(self.lines[y], x,
-                                   Char(' ', curses.A_NORMAL))
+            first_line = self.cursor.y
+            last_line = min(first_line + (count or 1), len(self.lines)) - 1
+        if last_line < first_line:
+            return
+        old = self.journal.texts(first_line, last_line + 1)
+        new = []
+        for text in old:
+            if right:
                 # TODO: Use tabs when specified
-        else:
-            for y in r:
-                line = self.lines[y]
-                if len(line) == 0:
-                    continue
-                if line[0].ch == '\t':
-                    # There is a tab to delete, stop here
-                    self.cursor.x = 0
-                    self.cursor.y = y
-                    self.delete_char_at_cursor('@')
-                    self.move_to_first_non_blank('^')
-                    continue
-                mx = 0
-                for n in range(len(line)):
-                    char = line[n]
-                    if char.ch != ' ':
-                        mx = n
-                        break
-                if mx >= 4:                 # TODO: use tab size instead of 4
-                    self.cursor.x = 0
-                    self.cursor.y = y
-                    self.delete_char_at_cursor('@')  # This deletes 4
-                    self.move_to_first_non_blank('^')
-
-    def shift_right(self, key):
-        self.shift(right=True)
-
-    def shift_left(self, key):
+                text = '    ' + text
+            elif text[:1] == '\t':
+                # There is a tab to delete, stop here
+                text = text[1:]
+            elif len(text) - len(text.lstrip(' ')) >= 4:
+                # TODO: use tab size instead of 4
+                text = text[4:]
+            new.append(text)
+        if new == old:
+            return
+        self.replace_lines(first_line, old, new)
+        if not right:
+            # On the last line shifted, as when doing them one by one
+            self.cursor.y = max(first_line + i for i in range(len(new))
+                                if new[i] != old[i])
+            self.cursor_and_viewport_adjustement()
+            self.move_to_first_non_blank('^')
+
+    def shift_right(self, key, count=None):
+        self.shift(right=True, count=count)
+
+    def shift_left(self, key, count=None):
         ''' Shift left one tab '''
-        self.shift(right=False)
+        self.shift(right=False, count=count)
@@ -18,70 +18,231 @@
  You should have received a copy of the GNU General Public License
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import codecs
 import curses
+import os
 from pabled.line import Line
 
+# Keys typed ahead taken at once by getkeys(), so a huge paste can not
+# keep the screen from being painted for long
+TYPEAHEAD = 4096
+
+# What the terminal sends around pasted text, once asked to with
+# set_paste()
+PASTE_START = b'\x1b[200~'
+PASTE_END = b'\x1b[201~'
+
+# Milliseconds to wait for the rest of a paste before giving up on it
+PASTE_WAIT = 1000
+
+# Milliseconds curses waits after an escape for the rest of the
+# sequence of a special key, instead of its default of one second
+ESCAPE_DELAY = 25
+
+# Code of the key pasted text is bound to, see Paste
+KEY_PASTE = curses.KEY_MAX + 1
+
+# Control characters (tabs among them) take one cell of a row, as a
+# space. addstr() would expand them, moving the rest of a run out of the
+# cells the canvas has them in
+CELLS = {c: ' ' for c in range(32)}
+CELLS[127] = ' '
+
+
+class Paste:
+    ''' Text pasted in the terminal, returned by Display.getkey() as a
+        single key. Keys runs the method bound to KEY_PASTE with it '''
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return 'paste'
+
 
 class Display:
     """ Abstract ncurses interface """
     def __init__(self, stdscr):
         self.stdscr = stdscr
         self.my, self.mx = self.stdscr.getmaxyx()
+        # Let curses use the terminal insert/delete line when scrolling
+        self.stdscr.idlok(True)
         self.status = Line(' ' * (self.mx))
-        # This is to redraw a snapshot() for fast overly animations
-        # (for hellfire :)
+        # What is on the screen, row by row, as a pair of the text and
+        # the list of attributes of every cell. New frames are compared
+        # against it, so only what changed is sent to curses (it is also
+        # used to redraw a snapshot() for fast overlay animations, for
+        # hellfire :)
         self.canvas = []
         for y in range(self.my):
-            self.canvas.append([])
-            for x in range(self.mx):
-                self.canvas[y].append({'str': ' ', 'attr': curses.A_NORMAL})
+            r = self.row_width(y)
+            self.canvas.append([' ' * r, [curses.A_NORMAL] * r])
+        # What the buffer rows were drawn from the last time
+        self.frame = None
+        # Added to the attribute of the matches of the last search
+        self.search_attribute = curses.A_REVERSE
+        # Spaces to fill the end of rows with
+        self.blank = ' ' * self.mx
+        # Milliseconds getkey() waits for a key, see set_timeout()
+        self.delay = -1
+        # Do not make escape wait, unless asked to in the environment
+        if 'ESCDELAY' not in os.environ and hasattr(curses, 'set_escdelay'):
+            curses.set_escdelay(ESCAPE_DELAY)
 
-    def update_line(self, y, line, buf=None):
+    def row_width(self, y):
+        ''' Number of cells drawn in row y '''
         # If it is the last line, do not write in the last cell
         if y == (self.my - 1):
-            r = self.mx - 1
+            return self.mx - 1
+        return self.mx
+
+    def render_line(self, y, line, buf=None, spans=None):
+        ''' Return the text and attributes line would have as row y
+            of the screen. Both are sliced out of the Line as a whole,
+            only a visual selection is looked at cell by cell. spans
+            are the (start, end) columns of the search matches in it '''
+        r = self.row_width(y)
+        if (buf is not None) and (buf.high is not None):
+            default = buf.high.default_attribute()
         else:
-            r = self.mx
-        for i in range(r):
-            if i < (len(line) - 1):
-                if (buf is not None and
-                    buf.in_visual_range(y + buf.viewport.y0,
-                                        i + buf.viewport.x0)):
-                    a = line[i].high
-                else:
-                    a = line[i].attr
-                ch = line[i].ch
-            else:
-                ch = ' '
-                if (buf is not None) and (buf.high is not None):
-                    a = buf.high.default_attribute()
-                else:
-                    a = curses.A_NORMAL
-            if type(ch) == str:
-                ch = ch.encode('utf-8')
-            elif type(ch) == str:
-                pass
-            self.canvas[y][i]['str'] = ch
-            self.canvas[y][i]['attr'] = a
-            self.stdscr.addstr(y, i, ch, a)
+            default = curses.A_NORMAL
+        k = max(0, min(len(line) - 1, r))
+        text = line.text[:k].translate(CELLS)
+        if line.attrs is None:
+            attrs = [curses.A_NORMAL] * k
+        else:
+            attrs = line.attrs[:k].tolist()
+        if buf is not None and buf.visual_cursor is not None:
+            for i in range(k):
+                if buf.in_visual_range(y + buf.viewport.y0,
+                                       i + buf.viewport.x0):
+                    attrs[i] = line[i].high
+        if spans:
+            for start, end in spans:
+                for i in range(start, min(end, k)):
+                    attrs[i] |= self.search_attribute
+        if k < r:
+            text += self.blank[:r - k]
+            attrs += [default] * (r - k)
+        return text, attrs
+
+    def update_line(self, y, line, buf=None, spans=None):
+        text, attrs = self.render_line(y, line, buf, spans)
+        self.draw_row(y, text, attrs)
         # Draw rule
         # self.stdscr.addstr(y, 80, '│', curses.A_NORMAL)
 
+    def runs(self, attrs, start=0, end=None):
+        ''' Yield the (start, end) spans of cells between start and
+            end sharing the same attribute '''
+        if end is None:
+            end = len(attrs)
+        i = start
+        while i < end:
+            a = attrs[i]
+            j = i + 1
+            while j < end and attrs[j] == a:
+                j += 1
+            yield i, j
+            i = j
+
+    def draw_row(self, y, text, attrs):
+        ''' Bring row y of the screen to text and attrs, writing only
+            the runs of cells that changed. Consecutive changed cells
+            with the same attribute go in a single addstr '''
+        old_text, old_attrs = self.canvas[y]
+        if text == old_text and attrs == old_attrs:
+            return
+        n = len(text)
+        if len(old_text) != n:
+            # Nothing known about the row, draw all of it
+            for i, j in self.runs(attrs):
+                self.stdscr.addstr(y, i, text[i:j], attrs[i])
+            self.canvas[y] = [text, attrs]
+            return
+        # Leave out the unchanged cells at both ends
+        first = 0
+        while text[first] == old_text[first] and \
+                attrs[first] == old_attrs[first]:
+            first += 1
+        last = n
+        while text[last - 1] == old_text[last - 1] and \
+                attrs[last - 1] == old_attrs[last - 1]:
+            last -= 1
+        i = first
+        while i < last:
+            if text[i] == old_text[i] and attrs[i] == old_attrs[i]:
+                i += 1
+                continue
+            a = attrs[i]
+            j = i + 1
+            while (j < last and attrs[j] == a and
+                   (text[j] != old_text[j] or old_attrs[j] != a)):
+                j += 1
+            self.stdscr.addstr(y, i, text[i:j], a)
+            i = j
+        self.canvas[y] = [text, attrs]
+
     def refresh(self):
         """ Refresh display using last canvas stored """
         for y in range(self.my):
-            for x in range(self.mx):
-                if (y == (self.my - 1)) and (x == (self.mx - 1)):
-                    pass
-                else:
-                    self.stdscr.addstr(y, x, self.canvas[y][x]['str'],
-                                       self.canvas[y][x]['attr'])
+            text, attrs = self.canvas[y]
+            for i, j in self.runs(attrs):
+                self.stdscr.addstr(y, i, text[i:j], attrs[i])
+
+    def scroll(self, dy):
+        ''' The viewport moved dy lines down (up if negative). If that
+            leaves some rows on the screen, let the terminal move them
+            with a scroll region, so only the rows that come in have to
+            be drawn '''
+        rows = self.my - 1     # All but the status line
+        if dy == 0 or abs(dy) >= rows:
+            return
+        self.stdscr.setscrreg(0, rows - 1)
+        self.stdscr.scrollok(True)
+        self.stdscr.scroll(dy)
+        self.stdscr.scrollok(False)
+        self.stdscr.setscrreg(0, self.my - 1)
+        unknown = [['', []] for i in range(abs(dy))]
+        if dy > 0:
+            self.canvas[0:rows] = self.canvas[dy:rows] + unknown
+        else:
+            self.canvas[0:rows] = unknown + self.canvas[0:rows + dy]
+
+    def invalidate(self):
+        ''' Forget what is on the screen, somebody else drew over it.
+            The next show() draws everything again '''
+        for y in range(self.my):
+            self.canvas[y] = ['', []]
+        self.frame = None
+        self.stdscr.touchwin()
 
     def show(self, buf):
         """ Refresh display after a motion command """
-        for y in range(0, self.my - 1):
-            n = y + buf.viewport.y0
-            self.update_line(y, buf[n], buf)
+        buf.highlight_viewport()
+        # The buffer rows only change if the text, its highlighting, the
+        # viewport, the visual selection or the search shown did.
+        # Otherwise (the cursor just moved) there is nothing to draw but
+        # the status line
+        if buf.high is not None:
+            changes = buf.high.changes
+        else:
+            changes = 0
+        if buf.visual_cursor is not None:
+            visual = (buf.visual_cursor.x, buf.visual_cursor.y,
+                      buf.cursor.x, buf.cursor.y)
+        else:
+            visual = None
+        found = buf.search_spans()
+        frame = (id(buf), buf.version, changes, buf.viewport.y0,
+                 buf.viewport.x0, visual, buf.hlsearch and buf.regexp)
+        if frame != self.frame:
+            if self.frame is not None and frame[0] == self.frame[0] and \
+                    frame[4] == self.frame[4]:
+                self.scroll(frame[3] - self.frame[3])
+            for y in range(0, self.my - 1):
+                n = y + buf.viewport.y0
+                self.update_line(y, buf[n], buf, found.get(n))
+            self.frame = frame
         self.update_line(self.my - 1, self.status)
         if buf.mode != buf.STATUS:
             rx = buf.cursor.x - buf.viewport.x0
@@ -113,7 +274,76 @@ class Display:
         self.print_in_statusline(0, ' ', self.mx)
 
     def getkey(self):
-        return get_char(self.stdscr)
+        key = get_char(self.stdscr)
+        if key == 27 and self.expect(PASTE_START[1:]):
+            return self.paste()
+        return key
+
+    def expect(self, sequence):
+        ''' Wether the bytes of sequence are the next ones typed. If
+            they are not, what was read is put back '''
+        read = []
+        self.stdscr.timeout(0)
+        for b in sequence:
+            c = self.stdscr.getch()
+            if c != -1:
+                read.append(c)
+            if c != b:
+                break
+        self.stdscr.timeout(self.delay)
+        if read == list(sequence):
+            return True
+        for c in reversed(read):
+            curses.ungetch(c)
+        return False
+
+    def paste(self):
+        ''' Read pasted text up to PASTE_END, and return it as a Paste.
+            Newlines may come as carriage returns '''
+        data = bytearray()
+        self.stdscr.timeout(PASTE_WAIT)
+        while not data.endswith(PASTE_END):
+            c = self.stdscr.getch()
+            if c == -1:
+                break
+            if c < 256:
+                data.append(c)
+        self.stdscr.timeout(self.delay)
+        if data.endswith(PASTE_END):
+            del data[-len(PASTE_END):]
+        text = data.decode('utf-8', 'replace')
+        return Paste(text.replace('\r\n', '\n').replace('\r', '\n'))
+
+    def set_paste(self, on):
+        ''' Ask the terminal to send pasted text between PASTE_START
+            and PASTE_END (or to stop doing it) '''
+        curses.putp(b'\x1b[?2004h' if on else b'\x1b[?2004l')
+
+    def getkeys(self):
+        ''' Wait for a key as getkey() does, and return a list with it
+            and all the keys already typed after it (up to TYPEAHEAD),
+            to process them before painting again. The list is empty if
+            no key arrived '''
+        key = self.getkey()
+        if key == -1:
+            return []
+        keys = [key]
+        # Take the rest without waiting
+        delay = self.delay
+        self.set_timeout(0)
+        while len(keys) < TYPEAHEAD:
+            key = self.getkey()
+            if key == -1:
+                break
+            keys.append(key)
+        self.set_timeout(delay)
+        return keys
+
+    def set_timeout(self, ms):
+        ''' Make getkey() return -1 if no key arrives in ms
+            milliseconds (wait forever if ms is -1) '''
+        self.delay = ms
+        self.stdscr.timeout(ms)
 
     def getmaxy(self):
         return self.my
@@ -122,42 +352,36 @@ class Display:
         return self.my, self.mx
 
 
-# Workaround for win.getch
-# https://groups.google.com/forum/#!topic/comp.lang.python/Z9zjDwonQqY
-# by Inigo Serna, modified to handle curses 'special keys'
 def get_char(win):
-    def get_check_next_byte():
-        c = win.getch()
-        if 128 <= c <= 191:
-            return c
-        else:
-            raise UnicodeError
+    ''' Return the next key typed in win: a character as a string, a
+        control character or a special key (see curses.KEY_*) as an
+        int, and -1 if none came before the timeout. Characters are
+        decoded by curses itself (get_wch), or from the UTF-8 bytes
+        read with getch where it is not available '''
+    if not hasattr(win, 'get_wch'):
+        return get_utf8_char(win)
+    try:
+        key = win.get_wch()
+    except curses.error:
+        return -1
+    if type(key) is str and key < ' ':
+        # Control+char, as getch() gives it
+        return ord(key)
+    return key
 
-    bytes = []
+
+def get_utf8_char(win):
+    ''' get_char() reading bytes with getch '''
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
     c = win.getch()
-    if c < 32:
-        # Control+char, return as is
-        return c
-    elif c <= 127:
-        # 1 bytes
-        bytes.append(c)
-    elif 194 <= c <= 223:
-        # 2 bytes
-        bytes.append(c)
-        bytes.append(get_check_next_byte())
-    elif 224 <= c <= 239:
-        # 3 bytes
-        bytes.append(c)
-        bytes.append(get_check_next_byte())
-        bytes.append(get_check_next_byte())
-    elif 240 <= c <= 244:
-        # 4 bytes
-        bytes.append(c)
-        bytes.append(get_check_next_byte())
-        bytes.append(get_check_next_byte())
-        bytes.append(get_check_next_byte())
-    else:   # Not an unicode string, but an encoded 'special key'
+    if c < 32 or c > 255:
+        # Control+char or special key, return as is
         return c
-    buf = (''.join([chr(b) for b in bytes]))
-    # raise Exception(buf.encode('utf-8'))
-    return str(buf)
+    key = decoder.decode(bytes([c]))
+    while key == '':
+        c = win.getch()
+        if c == -1 or c > 255:
+            # Cut short, whatever came is lost
+            return decoder.decode(b'', True)
+        key = decoder.decode(bytes([c]))
+    return key
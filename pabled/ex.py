@@ -19,13 +19,17 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import curses
+import os
 import random
 import shlex
-import copy
 import sys
 import re
 
 from pabled import game_2048
+from pabled.storage import write_file
+from pabled.search import compile_pattern
+from pabled.substitute import substitute_lines
+from pabled.registers import Registers
 
 
 class Commands:
@@ -39,21 +43,47 @@ class Commands:
         c = [d for d in c if d not in ['__init__', 'get_candidates',
                                        'get_range']]
         self.commands = c
-        self.yankring = []
+        self.registers = Registers()
+        # Processes :s uses on long ranges, None for one per CPU (see
+        # substitute_lines)
+        self.workers = 1
 
     def write(self, args, **kwargs):
+        ''' [range]w[!] [file] '''
+        # The file name comes as the argument in :w/tmp/foo, and after
+        # it in :w /tmp/foo
         a = args[0]
+        if a is None and len(args) > 1:
+            a = args[1]
         if a is None:
             path = self.path
         else:
             path = a
-        f = open(path, 'w')
-        for l in self.lines:
-            for char in l.chars:
-                if not (char.ch == u'\n' and l.noeol):
-                    f.write(char.ch.encode('utf-8'))
-        f.close()
-        self.display.print_in_statusline(0, '-- wrote ' + path + '--', 20)
+        self.load(wait=True)
+        # A bare :w writes the whole buffer even with a visual selection
+        if 'range' in kwargs and not (kwargs.get('visual') and a is None):
+            first_line, last_line = kwargs['range']
+            last_line = min(last_line, len(self.lines))
+            first_line = min(first_line, last_line)
+        else:
+            first_line, last_line = 0, len(self.lines)
+        # Writing part of the buffer over its own file would lose the
+        # rest of it, so it has to be forced with :w!
+        partial = first_line > 0 or last_line < len(self.lines)
+        if partial and self.path is not None and \
+                os.path.realpath(path) == os.path.realpath(self.path) and \
+                not kwargs.get('force'):
+            s = '-- Use ! to write partial buffer --'
+            self.display.print_in_statusline(0, s, len(s))
+            return
+        try:
+            write_file(self.lines, path, first_line, last_line)
+        except (IOError, OSError) as e:
+            s = '-- {}: {} --'.format(path, e.strerror)
+            self.display.print_in_statusline(0, s, len(s))
+            return
+        s = '-- wrote {} lines to {} --'.format(last_line - first_line, path)
+        self.display.print_in_statusline(0, s, len(s))
 
     def get_current_range(self, args, **kwargs):
         if 'range' in kwargs:
@@ -71,51 +101,62 @@ class Commands:
                 last_line = first_line + 1
         return first_line, last_line
 
-    # [range]d[elete]
+    # [range]d[elete] [x]
     def delete(self, args, **kwargs):
-        ''' delete the lines specified '''
-        first_line, last_line = self.get_current_range(kwargs)
+        ''' delete the lines specified, keeping them in register x '''
+        first_line, last_line = self.get_current_range(args, **kwargs)
         ndeleted = 0
-        if len(self.yankring) != 0:
-            self.yankring = []
+        last = min(last_line, len(self.lines))
+        self.registers.store(self.registers.take(args),
+                             self.lines.texts(first_line, last))
+        old = self.journal.texts(first_line, last)
         for n in range(first_line, last_line):
-            self.yankring.append(self.lines[first_line])
             del self.lines[first_line]
             if self.cursor.y >= first_line:
                 self.cursor.y -= 1
             ndeleted += 1
+        self.journal.lines(first_line, old, 0)
+        self.rescan(first_line, first_line)
         s = 'deleted {} lines'.format(ndeleted)
         self.display.print_in_statusline(0, s, len(s))
         self.cursor_and_viewport_adjustement()
         self.move_to_first_non_blank('d')
 
-    # [range]y[yank]
+    # [range]y[yank] [x]
     def yank(self, args, **kwargs):
-        ''' delete the lines specified '''
-        first_line, last_line = self.get_current_range(kwargs)
-        if len(self.yankring) != 0:
-            self.yankring = []
-        for n in range(first_line, last_line):
-            self.yankring.append(self.lines[n])
-        nyanked = len(self.yankring)
-        s = 'yanked {} lines'.format(nyanked)
+        ''' keep the lines specified in register x '''
+        first_line, last_line = self.get_current_range(args, **kwargs)
+        texts = self.lines.texts(first_line, min(last_line, len(self.lines)))
+        self.registers.store(self.registers.take(args), texts)
+        s = 'yanked {} lines'.format(len(texts))
         self.display.print_in_statusline(0, s, len(s))
         #self.cursor_and_viewport_adjustement()
         #self.move_to_first_non_blank('d')
 
-    # [range]p[aste]
+    # [range]p[aste] [x]
     def paste(self, args, **kwargs):
-        ''' Paste can not make use of any range, but whatever '''
+        ''' Paste can not make use of any range, but whatever. The
+            lines of register x go in as they are, see Registers '''
         y = self.cursor.y
-        self.lines = (self.lines[:(y + 1)] + copy.deepcopy(self.yankring) +
-                      self.lines[(y + 1):])
-        npasted = len(self.yankring)
+        texts = self.registers.get(self.registers.take(args))
+        if not texts:
+            # Nothing to undo then, keep what can be redone
+            self.display.print_in_statusline(0, '-- Nothing in register --',
+                                             40)
+            return
+        self.lines.insert_many(y + 1, texts)
+        npasted = len(texts)
+        self.journal.lines(y + 1, [], npasted)
+        self.rescan(y + 1, y + 1 + npasted)
         self.cursor.y += npasted
         s = 'pasted {} lines'.format(npasted)
         self.display.print_in_statusline(0, s, len(s))
 
     # [range]s[ubstitute]/{pattern}/{string}/[flags] [count]
     def substitute(self, args, **kwargs):
+        ''' Flags are g (all the matches in the line, not just the
+            first one) and i (ignore case). With a count, substitute in
+            count lines from the last one of the range '''
         array = self.split_with_backslash(args[0])
         flags = ''
         if len(array) == 0:
@@ -133,33 +174,67 @@ class Commands:
         else:   # Current line
             first_line = self.cursor.y
             last_line = first_line + 1
-        replacements = 0
-        lines_replaced = 0
-        last_cursor = [-1, -1]
-        for i in range(first_line, last_line):
-            x = 0
-            line_replaced = False
-            while True:
-                start, end = self.find(i, x, pattern)
-                if start is None:
-                    break
-                last_cursor[0] = start
-                self.lines[i].replace(start, end, string)
-                replacements += 1
-                line_replaced = True
-                last_cursor[1] = i
-                if flags != 'g':
-                    break
-            if line_replaced:
-                lines_replaced += 1
+        if len(args) > 1 and args[1].isdigit():
+            first_line = last_line - 1
+            last_line = first_line + int(args[1])
+        last_line = min(last_line, len(self.lines))
+        if 'i' in flags:
+            pattern = '(?i)' + pattern
+        self.reprog = compile_pattern(pattern)
+        # Chunks that can not match are skipped (see TrigramIndex)
+        replacements, lines_replaced, y, x = substitute_lines(
+            self.lines, self.reprog, string, first_line, last_line,
+            0 if 'g' in flags else 1, self.searcher.candidates(self.reprog),
+            self.workers, journal=self.journal)
+        self.rescan(first_line, last_line)
         s = '{} replacements in {} lines'.format(replacements, lines_replaced)
         self.display.print_in_statusline(0, s, len(s))
         # Move cursor to the start of the last replacement
-        if last_cursor[0] != -1:
-            self.cursor.x = last_cursor[0]
-            self.cursor.y = last_cursor[1]
+        if y is not None:
+            self.cursor.x = x
+            self.cursor.y = y
             self.cursor_and_viewport_adjustement()
-        # start, end = find(self, index, x, pattern=None):
+
+    # u[ndo]
+    def undo(self, args, **kwargs):
+        ''' Undo the last change (u) '''
+        if self.journal.undo():
+            s = '-- {} changes left to undo --'.format(len(self.journal.undos))
+        else:
+            s = '-- Already at oldest change --'
+        self.display.print_in_statusline(0, s, 40)
+
+    # red[o]
+    def redo(self, args, **kwargs):
+        ''' Redo the last change undone (Ctrl-R) '''
+        if self.journal.redo():
+            s = '-- {} changes left to redo --'.format(len(self.journal.redos))
+        else:
+            s = '-- Already at newest change --'
+        self.display.print_in_statusline(0, s, 40)
+
+    # subw[orkers] [n]
+    def subworkers(self, args, **kwargs):
+        ''' Show or set the number of processes substitutions of many
+            lines are run in, 0 for one per CPU '''
+        if len(args) > 1 and args[1].isdigit():
+            self.workers = int(args[1]) or None
+        s = 'subworkers={}'.format(self.workers or 0)
+        self.display.print_in_statusline(0, s, 40)
+
+    # undol[evels] [n]
+    def undolevels(self, args, **kwargs):
+        ''' Show or set the number of changes that can be undone '''
+        if len(args) > 1 and args[1].isdigit():
+            self.journal.levels = max(int(args[1]), 1)
+        s = 'undolevels={}'.format(self.journal.levels)
+        self.display.print_in_statusline(0, s, 40)
+
+    # noh[lsearch]
+    def nohlsearch(self, args, **kwargs):
+        ''' Stop showing the matches of the last search, until the next
+            one '''
+        self.hlsearch = False
 
     def quit(self, args, **kwargs):
         sys.exit(0)
@@ -209,6 +284,7 @@ class Commands:
     def game2048(self, args, **kwargs):
         pad, sminrow, smincol, smaxrow, smaxcol = self.get_centered_pad(80, 23)
         game_2048(pad, False, True, sminrow, smincol, smaxrow, smaxcol)
+        self.display.invalidate()
         self.display.show(self)
         return
 
@@ -249,6 +325,7 @@ class Commands:
             screen.timeout(30)
             if (screen.getch() != -1):
                 break
+        self.display.invalidate()
 
 
 class Ex(Commands):
@@ -299,6 +376,7 @@ class Ex(Commands):
         if line == '':
             return
         s = shlex.split(line)
+        visual = self.visual_cursor is not None
         rang, cmd, arg = self.get_range_cmd_arg(s[0])
         if arg is not None:
             args = [arg] + s[1:]
@@ -307,6 +385,13 @@ class Ex(Commands):
         kwargs = {}
         if rang is not None:
             kwargs['range'] = rang
+            # get_range() took it from the visual selection (and reset it)
+            if visual and self.visual_cursor is None:
+                kwargs['visual'] = True
+        # A trailing ! (as in :w!) forces the command
+        if cmd.endswith('!'):
+            cmd = cmd[:-1]
+            kwargs['force'] = True
         try:
             function_name = self.get_candidates(cmd)[0]
         except IndexError:
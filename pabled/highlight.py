@@ -19,7 +19,79 @@
 """
 import pygments
 import pygments.lexers
+import pygments.modeline
 import curses
+import os
+import queue
+import re
+import threading
+from array import array
+from pygments.lexer import RegexLexer
+from pygments.token import _TokenType, Error, Whitespace
+
+# Number of lines past the edited ones that are lexed before trusting
+# that the lexer state found at a line start is final. Tokens spanning
+# more lines than this (a whole block comment matched by one regexp in
+# some lexers) may be cut at the end of the lexed window
+SYNC_LINES = 50
+
+# Files with more lines than this are highlighted lazily, only around
+# the viewport, and LAZY_MARGIN lines are lexed above and below it
+LAZY_LINES = 5000
+LAZY_MARGIN = 100
+
+# Lines given to the background worker at once
+WORKER_LINES = 2000
+
+# When the lexer has to be guessed from the text, only this many
+# characters from the start of the file are looked at
+GUESS_CHARS = 16384
+
+# Where lexers guessed for a file name pattern are remembered, in the
+# XDG cache directory
+LEXER_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                           os.path.expanduser('~/.cache'), 'pabled', 'lexers')
+
+
+class LexerCache:
+    ''' Persistent mapping of file name patterns (*.ext, or the
+        whole name if there is no extension) to lexer aliases. Only
+        decisions taken by guessing are stored, as the others are
+        cheap to take again '''
+    def __init__(self, path=LEXER_CACHE):
+        self.path = path
+        self.patterns = {}
+        try:
+            with open(self.path, errors='replace') as f:
+                for line in f:
+                    tk = line.split()
+                    if len(tk) == 2:
+                        self.patterns[tk[0]] = tk[1]
+        except (IOError, OSError, ValueError):
+            pass
+
+    def pattern(self, path):
+        name = os.path.basename(path)
+        root, ext = os.path.splitext(name)
+        if ext != '':
+            return '*' + ext
+        return name
+
+    def get(self, path):
+        return self.patterns.get(self.pattern(path))
+
+    def set(self, path, alias):
+        pattern = self.pattern(path)
+        if pattern == '' or self.patterns.get(pattern) == alias:
+            return
+        self.patterns[pattern] = alias
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                for p in sorted(self.patterns):
+                    f.write('{} {}\n'.format(p, self.patterns[p]))
+        except (IOError, OSError):
+            pass
 
 # Default color scheme following vim defaults to
 # have something to start with. It is interesting to
@@ -94,18 +166,46 @@ Operator 8 16
 Comment 243 16
 Other red black"""
 
+class Job:
+    ''' Lines handed to the background worker to lex '''
+    def __init__(self, version, start, texts, stack):
+        self.version = version
+        self.start = start
+        self.texts = texts
+        self.stack = stack
+        self.cancelled = False
+
+
 class Highlighter:
     """ Fill the attributes of the text using Pygments """
-    def __init__(self, buffer):
+    def __init__(self, buffer, lazy=None, margin=LAZY_MARGIN):
         self.b = buffer
+        if lazy is None:
+            lazy = buffer.length() > LAZY_LINES
+        self.lazy = lazy
+        self.margin = margin
+        # Lines lexed in an older generation are stale
+        self.generation = 1
+        self.total = buffer.length()
+        # Background worker: when not lazy, lines from pending on are
+        # still to be lexed (by the worker) from an exact state
+        self.pending = None if lazy else 0
+        self.window = WORKER_LINES
+        # Bumped whenever stored attributes change, so the display
+        # knows when the screen has to be drawn again
+        self.changes = 0
+        self.job = None
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = None
         self.token_colors = {}
-        # first scan uses all the text to determine the lexer
-        t = self.b.extract_text(0, buffer.length())
-        try:
-            self.lexer = pygments.lexers.guess_lexer(t['text'])
-        except pygments.util.ClassNotFound:
-            # No lexer found
-            self.lexer = None
+        self.lexer = self.select_lexer(buffer.path)
+        # Lexers using the stock RegexLexer loop can be restarted at any
+        # line start from the state stack recorded there. Anything else
+        # is always lexed from the first line
+        self.incremental = (type(self.lexer).get_tokens_unprocessed is
+                            RegexLexer.get_tokens_unprocessed)
+        self.token_attrs = {}
         # ncurses colors table
         self.__colors = {'black': 0, 'red': 1, 'green': 2,
                          'yellow': 3, 'blue': 4, 'magenta': 5,
@@ -120,6 +220,57 @@ class Highlighter:
             self.setcolorschema(schema256)
         # self.setcolorschema(defcolschema)
 
+    def select_lexer(self, path):
+        ''' Choose a lexer looking, in order, at a modeline, the file
+            name, the interpreter in a #! line, the lexers cache and,
+            as a last resort, at the start of the text '''
+        head = []
+        size = 0
+        for n in range(self.b.length()):
+            head.append(self.b.lines.get_text(n))
+            size += len(head[-1])
+            if size >= GUESS_CHARS:
+                break
+        head = ''.join(head)[:GUESS_CHARS]
+        filetype = pygments.modeline.get_filetype_from_buffer(head)
+        if filetype is not None:
+            try:
+                return pygments.lexers.get_lexer_by_name(filetype)
+            except pygments.util.ClassNotFound:
+                pass
+        if path:
+            try:
+                return pygments.lexers.get_lexer_for_filename(path, head)
+            except pygments.util.ClassNotFound:
+                pass
+        shebang = re.match(r'#!\s*(\S+)(?:\s+(\S+))?', head)
+        if shebang is not None:
+            interpreter = os.path.basename(shebang.group(1))
+            if interpreter == 'env' and shebang.group(2) is not None:
+                interpreter = shebang.group(2)
+            # python3.11 -> python3 -> python
+            for name in (interpreter, interpreter.rstrip('.0123456789')):
+                try:
+                    return pygments.lexers.get_lexer_by_name(name)
+                except pygments.util.ClassNotFound:
+                    pass
+        cache = LexerCache()
+        if path:
+            alias = cache.get(path)
+            if alias is not None:
+                try:
+                    return pygments.lexers.get_lexer_by_name(alias)
+                except pygments.util.ClassNotFound:
+                    pass
+        try:
+            lexer = pygments.lexers.guess_lexer(head)
+        except pygments.util.ClassNotFound:
+            # No lexer found
+            return None
+        if path and lexer.aliases:
+            cache.set(path, lexer.aliases[0])
+        return lexer
+
     def default_attribute(self):
         c = pygments.token.string_to_tokentype('Token.Text')
         return self.token_colors[c]['color']
@@ -184,12 +335,319 @@ class Highlighter:
         # curses.color_pair(0)
 
     def scan(self, since, to):
-        t = self.b.extract_text(since, to)
+        self.update(since, to)
+
+    def trusted(self, y):
+        ''' Wether the state stored at the start of line y is exact '''
+        if self.lazy:
+            return self.b.lines[y].lexed == self.generation
+        return self.pending is None or y < self.pending
+
+    def update(self, since, to=None):
+        ''' Highlight lines since..to after they changed. Lexing starts
+            at the closest line start with a known lexer state and goes
+            on past to until the state found at a line start is the one
+            it had before, as from there on nothing changes.
+            Lexing stops margin lines past the viewport. In lazy mode
+            everything not lexed becomes stale, otherwise the rest is
+            left to the background worker '''
+        lines = self.b.lines
+        total = len(lines)
+        self.cancel()
+        # Lines after the change moved, and so did the pending ones
+        delta = total - self.total
+        self.total = total
+        if not self.lazy and not self.incremental:
+            self.pending = 0
+        elif self.pending is not None and self.pending > since:
+            self.pending = max(since, self.pending + delta)
+        if total == 0 or self.lexer is None:
+            return
+        since = min(since, total - 1)
+        if to is None or to <= since:
+            to = since + 1
+        to = min(to, total)
+        horizon = min(total, max(since + 1, self.b.viewport.y1 + 1) +
+                      self.margin)
+        if since >= horizon:
+            if self.lazy:
+                self.generation += 1
+            return
+        to = min(to, horizon)
+        # The state stored in line since itself may be outdated if
+        # lines were deleted or inserted right before it
+        before = max(since - 1, 0)
+        if self.lazy or not self.trusted(before):
+            start, stack, exact = self.checkpoint(before, self.margin)
+        else:
+            start, stack, exact = self.checkpoint(before)
+        first = start
+        window = (to - start) + 2 * SYNC_LINES
+        while start < total:
+            end = min(total, start + window)
+            texts = [lines.get_text(n) for n in range(start, end)]
+            states, attrs, highs = self.lex(texts, stack)
+            # Near the end of the window tokens may have been cut, so
+            # only trust the states found SYNC_LINES before it
+            if end == total:
+                limit = end
+            else:
+                limit = end - SYNC_LINES
+            stop = None
+            for y in range(max(to, start + 1), limit):
+                state = states[y - start]
+                if (state is not None and state == lines[y].state and
+                        self.trusted(y)):
+                    stop = y
+                    break
+            synced = stop is not None or end == total
+            if end == total and stop is None:
+                stop = total
+            if stop is None:
+                # Restart from the last trusted line start, if any
+                for y in range(limit - 1, start, -1):
+                    if states[y - start] is not None:
+                        stop = y
+                        break
+                else:
+                    window *= 2
+                    continue
+                stack = states[stop - start]
+            self.store(start, stop, states, attrs, highs, exact)
+            if synced:
+                if exact and stop == total:
+                    self.pending = None
+                return
+            start = stop
+            if start >= horizon:
+                if self.lazy:
+                    # Give up: lines not lexed may be stale now, so start
+                    # a new generation with only the ones just lexed
+                    self.generation += 1
+                    for y in range(first, start):
+                        lines[y].lexed = self.generation
+                elif exact and (self.pending is None or
+                                start < self.pending):
+                    self.pending = start
+                return
+
+    def store(self, start, stop, states, attrs, highs, exact=True):
+        ''' Store the results of lex() for lines start..stop. Results
+            not coming from an exact state do not replace exact ones '''
+        lines = self.b.lines
+        self.changes += 1
+        for y in range(start, stop):
+            if not exact and not self.lazy and self.trusted(y):
+                continue
+            i = y - start
+            line = lines[y]
+            line.state = states[i]
+            line.lexed = self.generation
+            line.set_attributes(0, attrs[i], highs[i])
+
+    def checkpoint(self, y, lookback=None):
+        ''' Return the closest line at or before y from where lexing
+            can start, the state stack to start with and wether it is
+            exact. If there is no known state in lookback lines, guess
+            the initial one '''
+        lines = self.b.lines
+        start = y
+        while start > 0:
+            if lines[start].state is not None and self.trusted(start):
+                return start, lines[start].state, True
+            if lookback is not None and y - start >= lookback:
+                return start, ('root',), False
+            start -= 1
+        return start, ('root',), True
+
+    def ensure(self, y0, y1):
+        ''' Make sure lines y0..y1 (both included) are highlighted,
+            lexing margin lines more at both sides '''
+        lines = self.b.lines
+        total = len(lines)
+        if total == 0 or self.lexer is None:
+            return
+        y1 = min(y1, total - 1)
+        for y in range(y0, y1 + 1):
+            if lines[y].lexed != self.generation:
+                break
+        else:
+            return
+        start, stack, exact = self.checkpoint(y, self.margin)
+        end = min(total, y1 + 1 + self.margin)
+        texts = [lines.get_text(n) for n in range(start, end)]
+        states, attrs, highs = self.lex(texts, stack)
+        self.store(start, end, states, attrs, highs, exact)
+
+    def busy(self):
+        ''' Wether there are lines left for the background worker '''
+        return self.pending is not None
+
+    def cancel(self):
+        ''' Cancel the background job, the text it got is outdated '''
+        if self.job is not None:
+            self.job.cancelled = True
+            self.job = None
+
+    def pump(self):
+        ''' Store whatever the background worker finished, and give it
+            more lines to lex. Return True if some lines changed '''
+        changed = False
+        while True:
+            try:
+                job, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if job is not self.job:
+                continue    # Cancelled
+            self.job = None
+            if result is None or job.version != self.b.version:
+                continue
+            states, attrs, highs = result
+            end = job.start + len(job.texts)
+            total = len(self.b.lines)
+            if end >= total:
+                stop = total
+            else:
+                for stop in range(end - SYNC_LINES, job.start, -1):
+                    if states[stop - job.start] is not None:
+                        break
+                else:
+                    # A token longer than the window, try a larger one
+                    self.window = min(total, self.window * 2)
+                    continue
+            self.store(job.start, stop, states, attrs, highs)
+            self.pending = None if stop == total else stop
+            changed = True
+        if self.pending is not None and self.job is None:
+            self.submit(self.pending)
+        return changed
+
+    def submit(self, y):
+        ''' Queue the lexing of the lines from y on '''
+        lines = self.b.lines
+        total = len(lines)
+        if y >= total:
+            self.pending = None
+            return
+        start, stack, exact = self.checkpoint(y)
+        if not self.incremental:
+            self.window = total
+        end = min(total, y + self.window)
+        texts = [lines.get_text(n) for n in range(start, end)]
+        self.job = Job(self.b.version, start, texts, stack)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+        self.jobs.put(self.job)
+
+    def work(self):
+        ''' Background worker, lexing the jobs in the queue '''
+        while True:
+            job = self.jobs.get()
+            if job.cancelled:
+                continue
+            result = self.lex(job.texts, job.stack, job)
+            self.results.put((job, result))
+
+    def attrs_for_token(self, tokentype):
+        ''' Cached get_attrs_for_token() '''
+        try:
+            return self.token_attrs[tokentype]
+        except KeyError:
+            attrs = self.get_attrs_for_token(tokentype)
+            self.token_attrs[tokentype] = attrs
+            return attrs
+
+    def lex(self, texts, stack=('root',), job=None):
+        ''' Lex consecutive lines, starting with the lexer state stack.
+            Return three lists with an entry per line: the state stack
+            at the line start (None if a token crosses it), and the
+            attrs and highs arrays for the line. Return None if job
+            gets cancelled meanwhile '''
+        text = ''.join(texts)
+        attribute, highlight = self.attrs_for_token(pygments.token.Text)
+        attrs = array('I', [attribute]) * len(text)
+        highs = array('I', [highlight]) * len(text)
+        starts = []
         index = 0
-        for tokentype, value in self.lexer.get_tokens(t['text']):
-            attribute, highlight = self.get_attrs_for_token(tokentype)
-            for i in range(len(value)):
-                (t['refs'][i + index]).attr = attribute
-                (t['refs'][i + index]).high = highlight
-                # if (i + index) < len(t['attributes']):
-            index += len(value)
+        for t in texts:
+            starts.append(index)
+            index += len(t)
+        states = [None] * len(texts)
+        states[0] = tuple(stack)
+        if self.incremental:
+            tokens = self.tokens(text, stack, starts, states)
+        else:
+            tokens = self.lexer.get_tokens_unprocessed(text)
+        for index, tokentype, value in tokens:
+            if job is not None and job.cancelled:
+                return None
+            attribute, highlight = self.attrs_for_token(tokentype)
+            n = len(value)
+            attrs[index:index + n] = array('I', [attribute]) * n
+            highs[index:index + n] = array('I', [highlight]) * n
+        starts.append(len(text))
+        lattrs = []
+        lhighs = []
+        for n in range(len(texts)):
+            lattrs.append(attrs[starts[n]:starts[n + 1]])
+            lhighs.append(highs[starts[n]:starts[n + 1]])
+        return states, lattrs, lhighs
+
+    def tokens(self, text, stack, starts, states):
+        ''' RegexLexer.get_tokens_unprocessed(), recording in states the
+            state stack every time a token ends right at a line start '''
+        lexer = self.lexer
+        pos = 0
+        nextline = 1
+        tokendefs = lexer._tokens
+        statestack = list(stack)
+        statetokens = tokendefs[statestack[-1]]
+        while 1:
+            for rexmatch, action, new_state in statetokens:
+                m = rexmatch(text, pos)
+                if m:
+                    if action is not None:
+                        if type(action) is _TokenType:
+                            yield pos, action, m.group()
+                        else:
+                            yield from action(lexer, m)
+                    pos = m.end()
+                    if new_state is not None:
+                        # state transition
+                        if isinstance(new_state, tuple):
+                            for state in new_state:
+                                if state == '#pop':
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif state == '#push':
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(state)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == '#push':
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                    break
+            else:
+                try:
+                    if text[pos] == '\n':
+                        # at EOL, reset state to "root"
+                        statestack = ['root']
+                        statetokens = tokendefs['root']
+                        yield pos, Whitespace, '\n'
+                    else:
+                        yield pos, Error, text[pos]
+                    pos += 1
+                except IndexError:
+                    break
+            while nextline < len(starts) and starts[nextline] < pos:
+                nextline += 1
+            if nextline < len(starts) and starts[nextline] == pos:
+                states[nextline] = tuple(statestack)
+                nextline += 1
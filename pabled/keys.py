@@ -18,27 +18,35 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import inspect
 from pabled.buffer import Buffer
+from pabled.display import KEY_PASTE, Paste
+
+# Keys making up the count of a command
+DIGITS = tuple('0123456789')
 
 
 class Keys:
-    """ Map c keys or key arrays to functions """
+    """ Map c keys or key arrays to functions. The keys of every mode
+        are kept in a trie: a dictionary from a key to the method bound
+        to it, or to the dictionary of the keys that can follow it in
+        a multikey command. In command mode a number typed before a
+        command is its count. Methods with a count argument get it
+        (None if there was none), the rest ignore it """
     def __init__(self):
         self.methods = {}
         self.default = {}
+        # Methods taking a count, see bind()
+        self.counted = set()
         self.count = 0
-        self.multi = None  # When in a multikey command, the string so far
+        self.node = None    # Where in a multikey command, if in one
         self.methods[Buffer.COMMAND] = {}
         self.methods[Buffer.INSERT] = {}
         self.methods[Buffer.STATUS] = {}
 
-        # Digits in command mode are for count
-        for n in range(10):
-            self.bind(Buffer.COMMAND, str(n), self.set_count)
-
     def bind(self, mode, key, method):
         ''' Bind a key or a list of keys to a certain method, referenced
-            by name '''
+            by name. A string of several keys binds the whole sequence '''
         if type(key) in (tuple, list):
             for i in key:
                 self.bind(mode, i, method)
@@ -47,52 +55,49 @@ class Keys:
             for m in mode:
                 self.bind(m, key, method)
             return
-        if type(key) is str:
-            if len(key) > 1:
-                if mode != Buffer.COMMAND:
-                    raise Exception('Multikeys are only allowed on COMMAND')
-                self.methods[mode][key[0]] = self.process_multi
+        if 'count' in inspect.signature(method).parameters:
+            self.counted.add(method)
         if key is None:
             self.default[mode] = method
-        else:
-            self.methods[mode][key] = method
+            return
+        node = self.methods[mode]
+        if type(key) is str and len(key) > 1:
+            for k in key[:-1]:
+                if type(node.get(k)) is not dict:
+                    node[k] = {}
+                node = node[k]
+            key = key[-1]
+        node[key] = method
 
     def process(self, key, mode):
         ''' Process key '''
-        try:
-            method = self.methods[mode][key]
-        except KeyError:
-            method = self.default[mode]
-        if method != self.set_count:
-            if self.count != 0:
-                for i in range(self.count):
-                    method(key)
-                self.count = 0
-                return
-        method(key)
-
-    def process_multi(self, key):
-        ''' Multikey continuation '''
-        if self.multi is None:
-            self.multi = key
-        else:
-            self.multi += key
-            # Check wether the whole string forms a command
-            # or not
-            try:
-                method = self.methods[Buffer.COMMAND][self.multi]
-            except KeyError:
+        root = self.methods[mode]
+        node = root if self.node is None else self.node
+        # 0 is a command of its own, unless it is part of a count
+        if (node is root and mode == Buffer.COMMAND and key in DIGITS and
+                (key != '0' or self.count != 0)):
+            self.count = self.count * 10 + int(key)
+            return
+        method = node.get(KEY_PASTE if type(key) is Paste else key)
+        if type(method) is dict:
+            # The rest of a multikey command
+            self.node = method
+            return
+        self.node = None
+        if method is None:
+            if node is not root:
                 # Send an escape to reset whatever needs to be reset
-                method = self.methods[Buffer.COMMAND][27]
-            self.multi = None
+                method = root.get(27, self.default[mode])
+            else:
+                method = self.default[mode]
+        count = self.count
+        self.count = 0
+        if method in self.counted:
+            method(key, count or None)
+        else:
+            # Nothing else can be repeated safely (3i, 3p...)
             method(key)
 
     def setmode(self, mode):
         ''' Change from command to edition mode and versavice '''
         self.mode = mode
-
-    def set_count(self, key):
-        if self.count == 0 and key == '0':
-            self.methods[Buffer.COMMAND]['0']
-        else:
-            self.count = int(str(self.count) + key)
@@ -18,15 +18,11 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import curses
+from array import array
 
 
 def insert_element(array, position, element):
-    i = len(array) - 1
-    array.append(array[i])
-    while i > position:
-        array[i] = array[i - 1]
-        i -= 1
-    array[position] = element
+    array.insert(position, element)
 
 
 def delete_element(array, position):
@@ -37,21 +33,14 @@ def delete_element(array, position):
     if position == l:
         # TODO: Join lines
         return
-    i = l
-    t = array[i]
-    while True:
-        array[i] = t
-        i -= 1
-        if i == position:
-            break
-        t = array[i]
-    if position != l:
-        del array[position]
+    del array[position]
 
 
 class Char:
     ''' Encapsulate both a character (as a unicode string)
         and it's attributes '''
+    __slots__ = ('ch', 'attr', 'high')
+
     def __init__(self, ch, attr):
         # if ch.__class__.__name__ != 'unicode':
         if ch.__class__.__name__ != 'str':
@@ -65,10 +54,55 @@ class Char:
         self.high = curses.A_REVERSE    # Until overwritten by highlight
 
 
+class CharView:
+    ''' Char-alike view over one position of a Line. Reading or
+        writing ch, attr and high goes straight to the Line '''
+    __slots__ = ('line', 'index')
+
+    def __init__(self, line, index):
+        self.line = line
+        self.index = index
+
+    @property
+    def ch(self):
+        return self.line.text[self.index]
+
+    @ch.setter
+    def ch(self, value):
+        self.line.splice(self.index, self.index + 1, value,
+                         self.attr, self.high)
+
+    @property
+    def attr(self):
+        if self.line.attrs is None:
+            return curses.A_NORMAL
+        return self.line.attrs[self.index]
+
+    @attr.setter
+    def attr(self, value):
+        self.line.get_attrs()[self.index] = value
+
+    @property
+    def high(self):
+        if self.line.highs is None:
+            return curses.A_REVERSE
+        return self.line.highs[self.index]
+
+    @high.setter
+    def high(self, value):
+        self.line.get_highs()[self.index] = value
+
+
 class Line:
-    ''' Class wrapping a line '''
+    ''' Class wrapping a line. The text is kept as a plain string
+        (always ending in '\\n') and the attributes as two arrays with
+        one entry per character, attrs for the normal attribute and
+        highs for the one used when selected. An array is None until
+        something different from the default is stored in it '''
+    __slots__ = ('text', 'attrs', 'highs', 'noeol', 'state', 'lexed',
+                 'origin')
+
     def __init__(self, string, attrs=None):
-        self.chars = []
         # Store wether the string do not end in \n (only
         # the last line can fit in that, and append the \n
         if string[-1] != u'\n':
@@ -76,104 +110,165 @@ class Line:
             string += u'\n'
         else:
             self.noeol = False
-        i = 0
-        lists = list(string)
-        while True:
-            try:
-                if attrs is not None:
-                    attr = attrs[i]
-                else:
-                    attr = curses.A_NORMAL
-                char = Char(lists[i], attr)
-                self.chars.append(char)
-            except IndexError:
-                break
-            i += 1
+        self.text = string
+        self.attrs = None
+        self.highs = None
+        # Lexer state at the start of the line and generation it
+        # was lexed in, see Highlighter
+        self.state = None
+        self.lexed = 0
+        # Number of the line in the MappedFile it was read from, until
+        # the text changes (see LineStore and write_file)
+        self.origin = None
+        if attrs is not None:
+            a = list(attrs[:len(string)])
+            a += [curses.A_NORMAL] * (len(string) - len(a))
+            self.attrs = array('I', a)
+
+    def get_attrs(self):
+        ''' Return the attrs array, creating it if needed '''
+        if self.attrs is None:
+            self.attrs = array('I', [curses.A_NORMAL]) * len(self.text)
+        return self.attrs
+
+    def get_highs(self):
+        ''' Return the highs array, creating it if needed '''
+        if self.highs is None:
+            self.highs = array('I', [curses.A_REVERSE]) * len(self.text)
+        return self.highs
+
+    def set_attributes(self, since, attrs, highs):
+        ''' Store a run of attributes starting at position since '''
+        to = since + len(attrs)
+        self.get_attrs()[since:to] = attrs
+        self.get_highs()[since:to] = highs
+
+    def splice(self, start, end, string, attr=curses.A_NORMAL,
+               high=curses.A_REVERSE):
+        ''' Replace the characters from start to end with string, all
+            of it with the same attributes '''
+        n = len(string)
+        if self.attrs is not None or attr != curses.A_NORMAL:
+            self.get_attrs()[start:end] = array('I', [attr]) * n
+        if self.highs is not None or high != curses.A_REVERSE:
+            self.get_highs()[start:end] = array('I', [high]) * n
+        self.text = self.text[:start] + string + self.text[end:]
+        self.origin = None
 
     def get_string_and_refs(self, refs, index):
         ''' Return the line as an string and update
             a dictionary of 'references' with pairs of
-            'position': Char. This is used by the Highlighter '''
-        s = []
-        for c in self.chars:
-            s.append(c.ch)
-            refs[index] = c
+            'position': CharView '''
+        for i in range(len(self.text)):
+            refs[index] = CharView(self, i)
             index += 1
-        return (''.join(s), index)
+        return (self.text, index)
 
     def __getitem__(self, n):
-        ''' Return the Char of a certain position '''
-        return self.chars[n]
+        ''' Return a view of the Char of a certain position '''
+        if n < 0:
+            n += len(self.text)
+        if n < 0 or n >= len(self.text):
+            raise IndexError('Line index out of range')
+        return CharView(self, n)
+
+    def __iter__(self):
+        for i in range(len(self.text)):
+            yield CharView(self, i)
 
     def __setitem__(self, key, value):
         ''' Set the character for a position. If passed an array
             of [char, attribute], set also the attribute. If
-            passed a Char object, simply assign it'''
+            passed a Char object, copy it'''
+        if key < 0:
+            key += len(self.text)
         if type(value) == list:
-            self.chars[key].ch = value[0]
-            self.chars[key].attr = value[1]
-        elif value.__class__.__name__ == 'Char':
-            self.chars[key] = value
+            self.splice(key, key + 1, value[0], value[1], self[key].high)
+        elif value.__class__.__name__ in ('Char', 'CharView'):
+            self.splice(key, key + 1, value.ch, value.attr, value.high)
         else:
-            #try:
-            self.chars[key].ch = value
-            #except IndexError:
-                #pass
-                # raise Exception(key)
+            self[key].ch = value
 
     def __len__(self):
-        return len(self.chars)
+        return len(self.text)
 
     def __delitem__(self, key):
-        del self.chars[key]
+        if type(key) is slice:
+            start, end, step = key.indices(len(self.text))
+        else:
+            if key < 0:
+                key += len(self.text)
+            start, end = key, key + 1
+        self.splice(start, end, u'')
+
+    def insert(self, position, ch):
+        ''' Insert a Char (or a plain string) before position '''
+        if type(ch) is str:
+            self.splice(position, position, ch)
+        else:
+            self.splice(position, position, ch.ch, ch.attr, ch.high)
 
     def append(self, ch):
-        return self.chars.append(ch)
+        return self.insert(len(self.text), ch)
 
     def add(self, line, trim=False):
         # Join another line
         # If the line to append only contains the '\n', do nothing
         if len(line) <= 1:
             return
+        text = line.text
+        skip = 0
+        if trim:    # Trim only for a join
+            stripped = text.lstrip(u' \t')
+            skip = len(text) - len(stripped)
+            text = stripped
         # First delete the last '\n'
-        del self.chars[-1]
-        for char in line:   # Trim only for a join
-            if trim:
-                if char.ch == u' ' or char.ch == u'\t':
-                    continue
-                else:
-                    self.chars.append(Char(u' ', None))  # Append one space
-                    trim = False
-            self.chars.append(char)
+        end = len(self.text) - 1
+        self.splice(end, end + 1, u'')
+        if trim:
+            self.append(u' ')   # Append one space
+        if line.attrs is not None:
+            self.get_attrs().extend(line.attrs[skip:])
+        elif self.attrs is not None:
+            self.attrs.extend(array('I', [curses.A_NORMAL]) * len(text))
+        if line.highs is not None:
+            self.get_highs().extend(line.highs[skip:])
+        elif self.highs is not None:
+            self.highs.extend(array('I', [curses.A_REVERSE]) * len(text))
+        self.text += text
+        self.noeol = line.noeol
 
     def replace(self, start, end, string):
-        refs = {}
         ''' Replace from start to end position with the contents of string '''
-        for delindex in reversed(range(start, end)):
-            try:
-                del self.chars[delindex]
-            except:
-                s, i = self.get_string_and_refs(refs, 0)
-                msg = '{}:{} -> {} in \'{}\' index {}'
-                raise Exception(msg.format(start, end, string, s, delindex))
-        for insertidx in range(start, start + len(string)):
-            c = string[insertidx - start]
-            insert_element(self, insertidx, Char(unicode(c), curses.A_NORMAL))
+        if end > len(self.text):
+            msg = '{}:{} -> {} in \'{}\''
+            raise Exception(msg.format(start, end, string, self.text))
+        self.splice(start, end, string)
 
     def split(self, position):
         ''' Return a new line from position to the end '''
-        r = Line(u'\n')
-        r.chars = self.chars[position:]
-        self.chars = self.chars[:position] + [Char(u'\n', None)]
+        r = Line(self.text[position:] or u'\n')
+        if self.attrs is not None:
+            r.attrs = self.attrs[position:]
+            self.attrs = self.attrs[:position] + array('I',
+                                                       [curses.A_NORMAL])
+        if self.highs is not None:
+            r.highs = self.highs[position:]
+            self.highs = self.highs[:position] + array('I',
+                                                       [curses.A_REVERSE])
+        r.noeol = self.noeol
+        self.noeol = False
+        self.text = self.text[:position] + u'\n'
+        self.origin = None
         return r
 
     def last_index(self, mode):
         ''' Return last indexable character in line.
-            This is from o to len(self.chars) removing the last '\n' '''
+            This is from o to len(self.text) removing the last '\\n' '''
         if mode == 0:   # Buffer.COMMAND
-            return len(self.chars) - 2
+            return len(self.text) - 2
         else:
-            return len(self.chars) - 1
+            return len(self.text) - 1
 
 
 class Cursor:
@@ -20,9 +20,14 @@
 import inspect
 import curses
 import locale
+import string
 import sys
 
 from pabled import Buffer, Display, Keys
+from pabled.display import KEY_PASTE
+
+# Milliseconds between repaints while highlighting in the background
+REPAINT_DELAY = 100
 
 
 class Pabled:
@@ -51,7 +56,8 @@ def set_command_mode_keys(keys, buf):
         [[curses.KEY_NPAGE, 6], 'page_forward'],
         [[curses.KEY_PPAGE, 2], 'page_backwards'],
         [[u'$', 70], 'cursor_to_eol'],
-        [[72], 'cursor_to_bol'],  # 0 is handled by the set_count callback
+        [[u'G'], 'goto_line'],
+        [[u'0', 72], 'cursor_to_bol'],  # Unless after a count, see Keys
         [[u'i'], 'insert'],
         [[u'x'], 'delete_char_at_cursor'],
         [[u'X'], 'delete_char_before_cursor'],
@@ -68,8 +74,12 @@ def set_command_mode_keys(keys, buf):
         [[u'D'], 'delete'],
         [[u'y'], 'yank'],
         [[u'p'], 'paste'],
+        [[u'"' + c for c in string.ascii_letters], 'select_register'],
+        [[u'u'], 'undo'],
+        [[18], 'redo'],
         [[u'>'], 'shift_right'],
         [[u'<'], 'shift_left'],
+        [[KEY_PASTE], 'insert_text'],
         [None, 'error']
     ]
     bind_array(keys, Buffer.COMMAND, cmds, buf)
@@ -86,6 +96,7 @@ def set_status_mode_keys(keys, buf):
         [[9], 'status_tab'],
         [[curses.KEY_BACKSPACE], 'status_backspace'],
         [[curses.KEY_DC], 'status_delete'],
+        [[KEY_PASTE], 'status_paste'],
         [None, 'status_insert']
     ]
     bind_array(keys, Buffer.STATUS, cmds, buf)
@@ -107,6 +118,7 @@ def set_insert_mode_keys(keys, buf):
         [[curses.KEY_BACKSPACE, 8], 'delete_char_before_cursor'],
         [[10], 'enter'],
         [[9], 'tab'],
+        [[KEY_PASTE], 'insert_text'],
         # Default command for the rest of keys (insert char'],
         [None, 'insert_char']
     ]
@@ -139,12 +151,43 @@ def main(stdscr, argv):
 
     display.show(buf)
 
+    # Pasted text comes as a single key, see Paste
+    display.set_paste(True)
+    try:
+        loop(display, buf, keys)
+    finally:
+        display.set_paste(False)
+
+
+def loop(display, buf, keys):
     while True:
-        key = display.getkey()
-        keys.process(key, buf.mode)
-        if buf.mode != buf.STATUS:
-            buf.refresh_status(key)
-        display.show(buf)
+        # While the highlighter works in the background, or the lines
+        # of the file are still being found, wake up now and then to
+        # paint what they finished (and to feed the trigram index)
+        if buf.high.busy() or buf.loading() or (buf.index is not None and
+                                                buf.index.busy()):
+            display.set_timeout(REPAINT_DELAY)
+        else:
+            display.set_timeout(-1)
+        # Keys typed ahead (or pasted) are all processed before painting
+        # again, and what they changed is rehighlighted once
+        pending = display.getkeys()
+        if pending:
+            buf.defer()
+            for key in pending:
+                keys.process(key, buf.mode)
+                if buf.mode == buf.COMMAND:
+                    # What the key changed is undone at once, and so is
+                    # a whole insert session, see Journal
+                    buf.journal.seal()
+            buf.flush()
+            if buf.mode != buf.STATUS:
+                buf.refresh_status(pending[-1])
+        loaded = buf.load()
+        if buf.index is not None:
+            buf.index.pump()
+        if buf.high.pump() or loaded or pending:
+            display.show(buf)
 
 
 # Entry point in setup.py for the /usr/local/bin/pabled script
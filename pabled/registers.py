@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+ registers - lines yanked and deleted, to be pasted
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Register always holding the last lines yanked or deleted
+UNNAMED = '"'
+
+
+class Registers:
+    ''' Lines yanked or deleted, by register name, as a tuple with the
+        text of every line (ending in '\\n', see LineStore.texts). Text
+        is immutable, so nothing is copied when storing or pasting it:
+        pasted lines go into the LineStore as raw entries, and become
+        Line objects only when looked at. "a to "z are the named
+        registers, "A to "Z append to them, and the unnamed one gets
+        whatever was stored last in any of them '''
+    def __init__(self):
+        self.texts = {}
+        # Register chosen with " for the next command
+        self.selected = None
+
+    def select(self, name):
+        self.selected = name
+
+    def take(self, args=None):
+        ''' Name of the register for a command: the one given to it
+            as an ex argument, or the one selected with " (forgotten
+            afterwards), or the unnamed one '''
+        selected = self.selected
+        self.selected = None
+        if type(args) is list and len(args) > 1 and len(args[1]) == 1:
+            return args[1]
+        if selected is None:
+            return UNNAMED
+        return selected
+
+    def store(self, name, texts):
+        ''' Keep texts in register name (appending to it if the name
+            is uppercase) and in the unnamed one '''
+        texts = tuple(texts)
+        if name.isupper():
+            name = name.lower()
+            texts = self.texts.get(name, ()) + texts
+        if name.isalpha():
+            self.texts[name] = texts
+        self.texts[UNNAMED] = texts
+
+    def get(self, name):
+        ''' Return the texts in register name, an empty tuple if none '''
+        return self.texts.get(name.lower(), ())
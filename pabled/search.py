@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+ search - regular expression search over the whole buffer
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+import re
+
+# Number of compiled patterns kept
+PATTERN_CACHE = 64
+
+
+@lru_cache(maxsize=PATTERN_CACHE)
+def compile_pattern(pattern):
+    ''' re.compile() pattern, remembering the last ones used. ^ and $
+        match at the start and end of every line '''
+    return re.compile(pattern, re.MULTILINE)
+
+
+class Search:
+    ''' Search the text of a buffer all at once. The text of all lines
+        is joined in a snapshot, kept until the buffer changes, along
+        with the offset in it where every chunk of the LineStore starts.
+        A match is turned back into a line and column counting the
+        newlines between the start of its chunk and it. Matches never
+        span lines, see matches(). If the buffer
+        has a TrigramIndex, chunks it rules out are not searched (a
+        match is then looked for inside a chunk, as before the snapshot
+        every line was searched on its own) '''
+    def __init__(self, buffer):
+        self.b = buffer
+        self.key = None
+        self.text = ''
+        self.offsets = array('Q')
+        self.starts = []
+        # Matches last found by spans(), and what for
+        self.spans_key = None
+        self.found = {}
+
+    def snapshot(self):
+        ''' Build the snapshot again if the buffer changed '''
+        lines = self.b.lines
+        key = (self.b.version, len(lines))
+        if key == self.key:
+            return
+        texts = []
+        self.offsets = array('Q')
+        offset = 0
+        for c in range(len(lines.chunks)):
+            text = lines.chunk_text(c)
+            self.offsets.append(offset)
+            offset += len(text)
+            texts.append(text)
+        self.starts = list(lines.starts)
+        self.text = ''.join(texts)
+        self.key = key
+
+    def position(self, y, x):
+        ''' Offset in the snapshot of column x of line y '''
+        y = min(y, len(self.b.lines) - 1)
+        c = bisect_right(self.starts, y) - 1
+        if c < 0:
+            return 0
+        offset = self.offsets[c]
+        for i in range(y - self.starts[c]):
+            offset = self.text.index('\n', offset) + 1
+        end = self.text.find('\n', offset)
+        if end == -1:
+            end = len(self.text)
+        return min(offset + x, end + 1)
+
+    def coordinates(self, offset):
+        ''' Line and column of an offset of the snapshot '''
+        c = bisect_right(self.offsets, offset) - 1
+        start = self.offsets[c]
+        y = self.starts[c] + self.text.count('\n', start, offset)
+        newline = self.text.rfind('\n', start, offset)
+        if newline == -1:
+            return y, offset - start
+        return y, offset - newline - 1
+
+    def candidates(self, prog):
+        ''' List telling for every chunk if prog may match in it, or None
+            if there is no way to tell '''
+        if self.b.index is None:
+            return None
+        return self.b.index.candidates(prog.pattern)
+
+    def end(self, c):
+        ''' Offset in the snapshot where chunk c ends '''
+        if c + 1 < len(self.offsets):
+            return self.offsets[c + 1]
+        return len(self.text)
+
+    def matches(self, prog, start, end):
+        ''' Matches of prog in the snapshot from start to end, each one
+            inside a line, as if every line was searched on its own.
+            Where a match found in the joined text spans several lines,
+            the first line of it is searched again alone '''
+        while start <= end:
+            match = prog.search(self.text, start, end)
+            if match is None:
+                return
+            # After the last newline there is no line left to match in
+            if match.start() == end and self.text[end - 1:end] == '\n':
+                return
+            eol = self.text.find('\n', match.start(), end)
+            if eol == -1:
+                eol = end
+            if match.end() > eol:
+                match = prog.search(self.text, match.start(), eol)
+                if match is None:
+                    start = eol + 1
+                    continue
+            yield match
+            start = match.end()
+            if match.end() == match.start():
+                start += 1
+
+    def spans(self, prog, y0, y1):
+        ''' Return a dictionary with the (start, end) columns of all the
+            matches of prog in each line from y0 to y1 (included) that
+            has any. They are only looked for again when the buffer, the
+            pattern or the lines change '''
+        lines = self.b.lines
+        key = (self.b.version, len(lines), prog.pattern, y0, y1)
+        if key == self.spans_key:
+            return self.found
+        self.found = {}
+        for y in range(y0, min(y1 + 1, len(lines))):
+            text = lines.get_text(y)
+            found = [match.span() for match in
+                     prog.finditer(text, 0, len(text) - 1)
+                     if match.end() > match.start()]
+            if found:
+                self.found[y] = found
+        self.spans_key = key
+        return self.found
+
+    def forward(self, prog, y, x):
+        ''' Return the line and column of the first match of prog at or
+            after column x of line y, or None, None '''
+        self.snapshot()
+        if len(self.text) == 0:
+            return None, None
+        start = self.position(y, x)
+        candidates = self.candidates(prog)
+        if candidates is None:
+            match = next(self.matches(prog, start, len(self.text)), None)
+        else:
+            match = None
+            c = bisect_right(self.offsets, start) - 1
+            while match is None and c < len(self.offsets):
+                if candidates[c]:
+                    match = next(self.matches(prog,
+                                              max(start, self.offsets[c]),
+                                              self.end(c)), None)
+                c += 1
+        if match is None:
+            return None, None
+        return self.coordinates(match.start())
+
+    def backward(self, prog, y, x):
+        ''' Return the line and column of the last match of prog that
+            starts before column x of line y, or None, None '''
+        self.snapshot()
+        if len(self.text) == 0:
+            return None, None
+        limit = self.position(y, x)
+        candidates = self.candidates(prog)
+        # Look for it a chunk at a time, from the one of the cursor back
+        c = bisect_right(self.offsets, limit) - 1
+        end = self.end(c)
+        while c >= 0:
+            found = None
+            if candidates is not None and not candidates[c]:
+                matches = []
+            else:
+                matches = self.matches(prog, self.offsets[c], end)
+            for match in matches:
+                if match.start() >= limit:
+                    break
+                found = match
+            if found is not None:
+                return self.coordinates(found.start())
+            end = limit = self.offsets[c]
+            c -= 1
+        return None, None
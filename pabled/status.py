@@ -52,8 +52,7 @@ class StatusLine:
 
     def status_enter(self, key):
         # Extract status string
-        refs = {}
-        s, i = self.display.status.get_string_and_refs(refs, 1)
+        s = self.display.status.text
         s = s[1:].rstrip()
         #raise Exception('status_first: [' +  str(self.status_first()) +
         #                '] string: [' + string + ']')
@@ -82,6 +81,11 @@ class StatusLine:
                        Char(key, curses.A_NORMAL))
         self.status_right('@')
 
+    def status_paste(self, key):
+        ''' Type the first line of the text of a Paste '''
+        for c in key.text.split('\n')[0]:
+            self.status_insert(c)
+
     def status_backspace(self, key):
         if self.sx == 1:
             self.status_cancel(key)
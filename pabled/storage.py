@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""
+ storage - LineStore, the text storage engine behind Buffer.lines
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import locale
+import mmap
+import os
+import shutil
+import tempfile
+from pabled.line import Line
+
+# Number of lines per chunk. Chunks are split when they grow to twice
+# this size and dropped when they become empty
+CHUNK = 512
+
+# Bytes of a file each process of an Indexer looks for newlines in
+INDEX_BLOCK = 16 * 1024 * 1024
+
+# Characters of text gathered before every write() when saving
+WRITE_BUFFER = 1024 * 1024
+
+
+def index_lines(data, start, end):
+    ''' Return an array with the offset of every line starting after
+        a newline found in data[start:end] '''
+    offsets = array('Q')
+    find = data.find
+    pos = find(b'\n', start, end)
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = find(b'\n', pos + 1, end)
+    return offsets
+
+
+def index_file(path, start, end):
+    ''' index_lines() for the bytes start..end of the file at path,
+        as run by the processes of an Indexer '''
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return index_lines(data, start, end)
+
+
+def lower_priority():
+    ''' Keep the processes of an Indexer from slowing down the editor '''
+    os.nice(10)
+
+
+class Indexer:
+    ''' Find the lines of a MappedFile in a pool of processes, each
+        looking for newlines in a block of INDEX_BLOCK bytes. Lines
+        start right after a \\n, and that byte is never part of a
+        multibyte UTF-8 sequence, so blocks can be split anywhere and
+        every offset found is a character boundary '''
+    def __init__(self, source, start, block=INDEX_BLOCK, workers=None):
+        self.source = source
+        self.pool = ProcessPoolExecutor(workers, initializer=lower_priority)
+        self.blocks = []
+        for n in range(start, source.size, block):
+            end = min(source.size, n + block)
+            future = self.pool.submit(index_file, source.path, n, end)
+            self.blocks.append((end, future))
+
+    def done(self):
+        return len(self.blocks) == 0
+
+    def progress(self):
+        ''' Percentage of the file already indexed '''
+        return self.source.indexed * 100 // self.source.size
+
+    def pump(self, wait=False):
+        ''' Add the lines found by the blocks finished so far, in order,
+            to the source (all of them if wait). Return True if there
+            were any '''
+        found = False
+        while self.blocks and (wait or self.blocks[0][1].done()):
+            end, future = self.blocks.pop(0)
+            self.source.add_offsets(future.result(), end)
+            found = True
+        if found and len(self.blocks) == 0:
+            self.source.finish()
+            self.pool.shutdown(wait=False)
+        return found
+
+
+class MappedFile:
+    ''' Read only view of a file through mmap. Only the offsets where
+        every line starts are kept in memory, the text of a line is
+        decoded from the map when asked for '''
+    def __init__(self, path, indexed=None):
+        self.path = path
+        self.encoding = locale.getpreferredencoding(False)
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            self.map = b''
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        # Only the lines ending before indexed are known. The rest are
+        # added with add_offsets() (see Indexer)
+        self.offsets = array('Q', [0])
+        self.indexed = 0
+        if indexed is None:
+            indexed = self.size
+        self.add_offsets(index_lines(self.map, 0, indexed), indexed)
+        if indexed == self.size:
+            self.finish()
+
+    def add_offsets(self, offsets, indexed):
+        ''' Add offsets, the starts of the lines found up to byte
+            indexed of the file, to the index '''
+        self.offsets.extend(offsets)
+        self.indexed = indexed
+
+    def finish(self):
+        ''' The whole file is indexed, add the last line '''
+        # Closing sentinel, unless the last line is empty (the file
+        # ends in \n), in which case it is already there
+        if self.offsets[-1] != self.size:
+            self.offsets.append(self.size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def detach(self):
+        ''' Go on reading from a private copy of the file, before it is
+            written over in place '''
+        copy = tempfile.TemporaryFile()
+        copy.write(self.map)
+        copy.flush()
+        if self.size != 0:
+            self.map = mmap.mmap(copy.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file.close()
+        self.file = copy
+
+    def block_text(self, first, last):
+        ''' Decoded text of lines first..last (not included), the same
+            as joining their text() '''
+        data = self.map[self.offsets[first]:self.offsets[last]]
+        return data.decode(self.encoding, 'replace').replace('\r\n', '\n')
+
+    def text(self, n):
+        ''' Decoded text of line n, with the newline it has (if any) '''
+        data = self.map[self.offsets[n]:self.offsets[n + 1]]
+        text = data.decode(self.encoding, 'replace')
+        # Same as reading the file in text mode
+        if text[-2:] == '\r\n':
+            text = text[:-2] + '\n'
+        return text
+
+
+class LineStore:
+    ''' List-alike container of lines, stored as a flat rope: a list
+        of chunks of at most 2 * CHUNK entries, plus the index of the
+        first line of every chunk. Inserting or deleting a line only
+        shifts one chunk and updates the chunk starts, instead of
+        copying the whole list of lines.
+
+        Entries are either Line objects, the raw text of a line, as
+        read from the file, or the number of a line in source, a
+        MappedFile. Raw and source entries are turned into a Line the
+        first time they are accessed with [], so the original text is
+        kept as is until somebody looks at it. Chunks of lines from
+        source nobody touched are just a range of line numbers.
+
+        For every chunk there is also a slot for the trigram bloom
+        filter of its text (see TrigramIndex), None until it is built
+        and again as soon as the chunk changes '''
+    def __init__(self, items=None, source=None):
+        self.chunks = []
+        self.starts = []
+        self.blooms = []
+        self.length = 0
+        self.source = source
+        if source is not None:
+            self.grow(0)
+        if items is not None:
+            self.extend(items)
+
+    def grow(self, first):
+        ''' Append the lines of source from first on, after it was
+            indexed further '''
+        total = len(self.source)
+        for n in range(first, total, CHUNK):
+            self.chunks.append(range(n, min(total, n + CHUNK)))
+            self.blooms.append(None)
+            self.starts.append(self.length)
+            self.length += len(self.chunks[-1])
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length != 0
+
+    def __iter__(self):
+        for c in range(len(self.chunks)):
+            for i in range(len(self.chunks[c])):
+                yield self.materialize(c, i)
+
+    def __getitem__(self, n):
+        if type(n) is slice:
+            return [self[i] for i in range(*n.indices(self.length))]
+        c, i = self.locate(n)
+        return self.materialize(c, i)
+
+    def __setitem__(self, n, value):
+        if type(n) is slice:
+            start, stop, step = n.indices(self.length)
+            if step != 1:
+                raise ValueError('LineStore only supports contiguous slices')
+            if stop > start:
+                del self[start:stop]
+            self.insert_many(start, value)
+            return
+        c, i = self.locate(n)
+        self.writable(c)[i] = value
+        self.blooms[c] = None
+
+    def __delitem__(self, n):
+        if type(n) is slice:
+            start, stop, step = n.indices(self.length)
+            if step != 1:
+                raise ValueError('LineStore only supports contiguous slices')
+            self.delete_range(start, stop)
+            return
+        if n < 0:
+            n += self.length
+        self.delete_range(n, n + 1)
+
+    def locate(self, n):
+        ''' Return the number of the chunk holding line n and the index
+            inside it '''
+        if n < 0:
+            n += self.length
+        if n < 0 or n >= self.length:
+            raise IndexError('line index out of range')
+        c = bisect_right(self.starts, n) - 1
+        return c, n - self.starts[c]
+
+    def writable(self, c):
+        ''' Return chunk c, as a list if it was still a range '''
+        chunk = self.chunks[c]
+        if type(chunk) is range:
+            chunk = list(chunk)
+            self.chunks[c] = chunk
+        return chunk
+
+    def materialize(self, c, i):
+        ''' Turn the raw entry i of chunk c into a Line, and keep it '''
+        item = self.chunks[c][i]
+        if type(item) is not Line:
+            line = Line(self.raw_text(item))
+            if type(item) is int:
+                line.origin = item
+            self.writable(c)[i] = line
+            return line
+        return item
+
+    def raw_text(self, item):
+        ''' Text of a raw or source entry, as it was in the file '''
+        if type(item) is int:
+            return self.source.text(item)
+        return item
+
+    def get_text(self, n):
+        ''' Return the text of line n, always ending in '\\n' as in
+            Line, without creating a Line object for it '''
+        c, i = self.locate(n)
+        item = self.chunks[c][i]
+        if type(item) is Line:
+            return item.text
+        item = self.raw_text(item)
+        if item[-1:] != '\n':
+            item += '\n'
+        return item
+
+    def chunk_text(self, c):
+        ''' Return the text of all the lines of chunk c, each ending in
+            '\\n' as in get_text() '''
+        chunk = self.chunks[c]
+        if type(chunk) is range:
+            text = self.source.block_text(chunk[0], chunk[-1] + 1)
+            if text[-1:] != '\n':
+                text += '\n'
+            return text
+        texts = []
+        for item in chunk:
+            if type(item) is Line:
+                texts.append(item.text)
+            else:
+                item = self.raw_text(item)
+                if item[-1:] != '\n':
+                    item += '\n'
+                texts.append(item)
+        return ''.join(texts)
+
+    def texts(self, since, to):
+        ''' Return a list with the text of lines since..to (not
+            included) as get_text() does, decoding the lines of source
+            nobody touched a chunk at a time '''
+        found = []
+        while since < to:
+            c, i = self.locate(since)
+            chunk = self.chunks[c]
+            j = min(len(chunk), i + to - since)
+            if type(chunk) is range:
+                parts = self.source.block_text(chunk[i],
+                                               chunk[j - 1] + 1).split('\n')
+                if parts[-1] == '':
+                    parts.pop()
+                found.extend([part + '\n' for part in parts])
+            else:
+                for item in chunk[i:j]:
+                    if type(item) is Line:
+                        found.append(item.text)
+                    else:
+                        item = self.raw_text(item)
+                        if item[-1:] != '\n':
+                            item += '\n'
+                        found.append(item)
+            since += j - i
+        return found
+
+    def get_file_text(self, n):
+        ''' Return the text of line n as it goes to a file: without the
+            '\\n' if the line had none '''
+        c, i = self.locate(n)
+        item = self.chunks[c][i]
+        if type(item) is Line:
+            if item.noeol:
+                return item.text[:-1]
+            return item.text
+        return self.raw_text(item)
+
+    def append(self, item):
+        self.insert_many(self.length, [item])
+
+    def extend(self, items):
+        self.insert_many(self.length, items)
+
+    def insert(self, n, item):
+        self.insert_many(n, [item])
+
+    def insert_many(self, n, items):
+        ''' Insert a list of lines (or raw texts) before line n '''
+        items = list(items)
+        if len(items) == 0:
+            return
+        if n < 0:
+            n = max(0, n + self.length)
+        n = min(n, self.length)
+        if len(self.chunks) == 0:
+            self.chunks.append([])
+            self.starts.append(0)
+            self.blooms.append(None)
+            c = 0
+        else:
+            c = bisect_right(self.starts, n) - 1
+        chunk = self.writable(c)
+        i = n - self.starts[c]
+        chunk[i:i] = items
+        self.length += len(items)
+        self.blooms[c] = None
+        if len(chunk) > 2 * CHUNK:
+            pieces = [chunk[j:j + CHUNK] for j in range(0, len(chunk), CHUNK)]
+            self.chunks[c:c + 1] = pieces
+            self.blooms[c:c + 1] = [None] * len(pieces)
+        self.reindex(c)
+
+    def delete_range(self, since, to):
+        ''' Delete lines from since up to (not including) to '''
+        since = max(since, 0)
+        to = min(to, self.length)
+        if to <= since:
+            return
+        c = bisect_right(self.starts, since) - 1
+        first = c
+        n = since
+        while n < to:
+            chunk = self.writable(c)
+            i = n - self.starts[c]
+            j = min(len(chunk), i + (to - n))
+            del chunk[i:j]
+            n += j - i
+            c += 1
+        self.length -= to - since
+        # Drop the chunks that became empty, and glue the ones left
+        # small to their neighbours so chunks do not fragment
+        kept = [ch for ch in self.chunks[first:c] if len(ch) > 0]
+        self.chunks[first:c] = kept
+        self.blooms[first:c] = [None] * len(kept)
+        first = max(first - 1, 0)
+        for c in (first + 1, first):
+            if c < len(self.chunks) - 1:
+                if len(self.chunks[c]) + len(self.chunks[c + 1]) <= CHUNK:
+                    self.writable(c).extend(self.chunks.pop(c + 1))
+                    self.blooms.pop(c + 1)
+                    self.blooms[c] = None
+        self.reindex(first)
+
+    def invalidate(self, since, to):
+        ''' The text of lines since..to (not included) changed, forget
+            the blooms of their chunks '''
+        if self.length == 0:
+            return
+        since = min(max(since, 0), self.length - 1)
+        to = min(max(to, since + 1), self.length)
+        first = bisect_right(self.starts, since) - 1
+        last = bisect_right(self.starts, to - 1) - 1
+        for c in range(first, last + 1):
+            self.blooms[c] = None
+
+    def reindex(self, c):
+        ''' Recalculate the starts of chunks from chunk c onwards '''
+        del self.starts[c:]
+        if c == 0:
+            n = 0
+        else:
+            n = self.starts[c - 1] + len(self.chunks[c - 1])
+        for chunk in self.chunks[c:]:
+            self.starts.append(n)
+            n += len(chunk)
+
+
+def copy_bytes(source, f, offset, count):
+    ''' Copy count bytes of source (a MappedFile) from offset on to the
+        end of f, in the kernel if it can be done '''
+    src = source.file.fileno()
+    dst = f.fileno()
+    while count > 0:
+        try:
+            n = os.copy_file_range(src, dst, count, offset)
+        except (AttributeError, OSError):
+            try:
+                n = os.sendfile(dst, src, offset, count)
+            except (AttributeError, OSError):
+                n = 0
+        if n == 0:
+            n = f.write(source.map[offset:offset + min(count, WRITE_BUFFER)])
+        offset += n
+        count -= n
+
+
+class Writer:
+    ''' Write text, and lines of a MappedFile taken as they are in it,
+        to a file. Text is gathered in WRITE_BUFFER pieces, and
+        consecutive lines of the MappedFile copied at once '''
+    def __init__(self, f, source, encoding):
+        self.f = f
+        self.source = source
+        self.encoding = encoding
+        self.pending = []
+        self.size = 0
+        # Lines of source pending to be copied, [first, last)
+        self.first = self.last = None
+
+    def text(self, text):
+        if self.first is not None:
+            self.flush_copy()
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size >= WRITE_BUFFER:
+            self.flush_text()
+
+    def copy(self, first, last):
+        ''' Copy lines first..last (not included) of source '''
+        if self.first is not None and self.last == first:
+            self.last = last
+            return
+        self.flush()
+        self.first, self.last = first, last
+
+    def flush_text(self):
+        if self.pending:
+            self.f.write(''.join(self.pending).encode(self.encoding))
+            self.pending = []
+            self.size = 0
+
+    def flush_copy(self):
+        if self.first is not None:
+            offsets = self.source.offsets
+            start = offsets[self.first]
+            copy_bytes(self.source, self.f, start,
+                       offsets[self.last] - start)
+            self.first = self.last = None
+
+    def flush(self):
+        self.flush_text()
+        self.flush_copy()
+
+
+def write_file(lines, path, first=0, last=None):
+    ''' Write lines first..last (not included) of a LineStore to path.
+        The text goes to a temporary file next to it that then replaces
+        path at once, so path is never left half written (and a
+        MappedFile of it keeps its contents). Symbolic links are
+        followed, and a file with other hard links to it is written
+        over in place instead, not to break them. Lines still as they were
+        in the MappedFile of the LineStore are copied from it, a whole
+        chunk at a time if none of its lines changed '''
+    if last is None:
+        last = len(lines)
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if lines.source is not None:
+        encoding = lines.source.encoding
+    else:
+        encoding = locale.getpreferredencoding(False)
+    fd, temporary = tempfile.mkstemp(prefix='.' + name + '.', dir=directory)
+    try:
+        with open(fd, 'wb', buffering=0) as f:
+            writer = Writer(f, lines.source, encoding)
+            n = first
+            while n < last:
+                c, i = lines.locate(n)
+                chunk = lines.chunks[c]
+                stop = min(len(chunk), i + last - n)
+                if type(chunk) is range:
+                    writer.copy(chunk[i], chunk[stop - 1] + 1)
+                else:
+                    for item in chunk[i:stop]:
+                        if type(item) is Line:
+                            origin = item.origin
+                        elif type(item) is int:
+                            origin = item
+                        else:
+                            origin = None
+                        if origin is not None:
+                            writer.copy(origin, origin + 1)
+                        elif type(item) is Line:
+                            if item.noeol:
+                                writer.text(item.text[:-1])
+                            else:
+                                writer.text(item.text)
+                        else:
+                            writer.text(item)
+                n += stop - i
+            writer.flush()
+        if st is None:
+            # mkstemp() makes it private, a new file gets the usual mode
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary, 0o666 & ~umask)
+        else:
+            try:
+                os.chown(temporary, st.st_uid, st.st_gid)
+            except OSError:
+                pass    # Only allowed to some
+            os.chmod(temporary, st.st_mode & 0o7777)
+        if st is not None and st.st_nlink > 1:
+            source = lines.source
+            if source is not None and os.path.samestat(
+                    os.fstat(source.file.fileno()), st):
+                source.detach()
+            with open(temporary, 'rb') as f, open(path, 'wb') as g:
+                shutil.copyfileobj(f, g)
+            os.unlink(temporary)
+        else:
+            os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+ substitute - the string replacement engine behind :s
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import multiprocessing
+import os
+from pabled.line import Line
+
+# Lines a substitution has to go through to be run in a pool of
+# processes. Below that starting the pool takes longer than the work
+PARALLEL_LINES = 100000
+
+# Chunks of the LineStore given to each process at once
+PARALLEL_CHUNKS = 64
+
+
+def template(string):
+    ''' re.sub() template inserting string as it is '''
+    return string.replace('\\', '\\\\')
+
+
+def last_column(prog, string, body, n):
+    ''' Column where the last of the first n matches of prog in body
+        is in the text re.subn() makes replacing them with string '''
+    column = 0
+    shift = 0
+    for match in islice(prog.finditer(body), n):
+        column = match.start() + shift
+        shift += len(string) - (match.end() - match.start())
+    return column
+
+
+def substitute_lines(lines, prog, string, first, last, count=1,
+                     candidates=None, workers=1, journal=None):
+    ''' Replace the matches of prog with string in lines first..last
+        (not included) of a LineStore. Every line is replaced as a whole
+        with re.subn() over its text, at most count times (0 for all
+        the matches), going through the LineStore a chunk at a time and
+        skipping the chunks candidates (see Search.candidates) rules
+        out. Return the number of replacements, the number of lines
+        changed and the line and column the last replacement ended up in
+        (None, None if there was none). Long ranges are handed
+        to substitute_parallel() if given more than one worker (None
+        for one per CPU). The lines changed are recorded in journal, if
+        given (see Journal) '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and last - first >= PARALLEL_LINES:
+        return substitute_parallel(lines, prog, string, first, last, count,
+                                   candidates, workers, journal)
+    return substitute_serial(lines, prog, string, first, last, count,
+                             candidates, journal)
+
+
+def substitute_serial(lines, prog, string, first, last, count=1,
+                      candidates=None, journal=None):
+    ''' substitute_lines() in this process '''
+    repl = template(string)
+    replacements = 0
+    changed = 0
+    last_y = None
+    last_text = None
+    last_n = 0
+    c = max(bisect_right(lines.starts, first) - 1, 0)
+    while c < len(lines.chunks) and lines.starts[c] < last:
+        start = lines.starts[c]
+        chunk = lines.chunks[c]
+        if candidates is not None and not candidates[c]:
+            c += 1
+            continue
+        for i in range(max(first - start, 0), min(last - start, len(chunk))):
+            item = chunk[i]
+            if type(item) is Line:
+                body = item.text[:-1]
+            else:
+                body = lines.raw_text(item)
+                if body[-1:] == '\n':
+                    body = body[:-1]
+            new, n = prog.subn(repl, body, count)
+            if n == 0:
+                continue
+            lines.materialize(c, i).splice(0, len(body), new)
+            chunk = lines.chunks[c]     # May be a list now
+            if journal is not None:
+                journal.span(start + i, 0, body, new)
+            replacements += n
+            changed += 1
+            last_y = start + i
+            last_text = body
+            last_n = n
+        c += 1
+    if last_y is None:
+        return replacements, changed, None, None
+    return (replacements, changed, last_y,
+            last_column(prog, string, last_text, last_n))
+
+
+def substitute_text(prog, string, count, jobs):
+    ''' re.subn() every line of jobs, a list of (c, lo, hi, text) with
+        the text of chunk c and the lines of it to go through, as run
+        by the processes of substitute_parallel(). Return a list with
+        (c, i, length, new, n) for every line changed, the length of its
+        old text included, and the column of the last replacement in
+        the last one '''
+    repl = template(string)
+    changes = []
+    last = None
+    for c, lo, hi, text in jobs:
+        bodies = text.split('\n')
+        for i in range(lo, hi):
+            body = bodies[i]
+            new, n = prog.subn(repl, body, count)
+            if n == 0:
+                continue
+            changes.append((c, i, len(body), new, n))
+            last = body, n
+    if last is None:
+        return changes, None
+    return changes, last_column(prog, string, *last)
+
+
+def pool_context():
+    ''' Way to start the processes of substitute_parallel(). Not fork,
+        as the highlighter and the trigram index have threads running '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def substitute_parallel(lines, prog, string, first, last, count=1,
+                        candidates=None, workers=None, journal=None):
+    ''' substitute_lines() in a pool of processes, each given the text
+        of PARALLEL_CHUNKS chunks at a time. What they replace is put
+        back into the LineStore in order '''
+    replacements = 0
+    changed = 0
+    last_y = None
+    last_x = None
+    futures = []
+    with ProcessPoolExecutor(workers, mp_context=pool_context()) as pool:
+        jobs = []
+        c = max(bisect_right(lines.starts, first) - 1, 0)
+        while c < len(lines.chunks) and lines.starts[c] < last:
+            if candidates is None or candidates[c]:
+                start = lines.starts[c]
+                jobs.append((c, max(first - start, 0),
+                             min(last - start, len(lines.chunks[c])),
+                             lines.chunk_text(c)))
+                if len(jobs) == PARALLEL_CHUNKS:
+                    futures.append(pool.submit(substitute_text, prog,
+                                               string, count, jobs))
+                    jobs = []
+            c += 1
+        if jobs:
+            futures.append(pool.submit(substitute_text, prog, string,
+                                       count, jobs))
+        for future in futures:
+            changes, x = future.result()
+            for c, i, length, new, n in changes:
+                line = lines.materialize(c, i)
+                if journal is not None:
+                    journal.span(lines.starts[c] + i, 0, line.text[:length],
+                                 new)
+                line.splice(0, length, new)
+                replacements += n
+                changed += 1
+                last_y = lines.starts[c] + i
+                last_x = x
+    return replacements, changed, last_y, last_x
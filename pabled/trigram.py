@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+ trigram - trigram index to narrow searches in big buffers
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from functools import lru_cache
+import queue
+import re
+import threading
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Buffers with more lines than this get a trigram index
+INDEX_LINES = 20000
+
+# Bits of the bloom filter of every chunk (a power of two)
+BLOOM_BITS = 1 << 16
+
+# Chunks given to the background worker at once
+INDEX_CHUNKS = 64
+
+
+@lru_cache(maxsize=64)
+def literals(pattern):
+    ''' Return the strings any match of pattern has to contain, the runs
+        of plain characters in its top level sequence. Patterns that
+        can not be narrowed that way (alternatives at the top level,
+        ignoring case) give none '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, OverflowError, RecursionError):
+        return ()
+    if parsed.state.flags & re.IGNORECASE:
+        return ()
+    found = []
+    run = []
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            found.append(''.join(run))
+            run = []
+    if run:
+        found.append(''.join(run))
+    return tuple(found)
+
+
+@lru_cache(maxsize=64)
+def trigram_hashes(pattern):
+    ''' Bloom filter positions of the trigrams of the literals of
+        pattern, empty if the index can not be used for it '''
+    hashes = set()
+    for literal in literals(pattern):
+        for trigram in trigrams(literal):
+            hashes.add(hash(trigram) & (BLOOM_BITS - 1))
+    return tuple(hashes)
+
+
+def trigrams(text):
+    ''' Return the set of trigrams of the UTF-8 bytes of text, as
+        tuples of three ints (which hash the same in any process) '''
+    data = text.encode('utf-8', 'surrogatepass')
+    return set(zip(data, data[1:], data[2:]))
+
+
+def bloom(text):
+    ''' Return the bloom filter of the trigrams in text '''
+    bits = bytearray(BLOOM_BITS // 8)
+    mask = BLOOM_BITS - 1
+    for trigram in trigrams(text):
+        h = hash(trigram) & mask
+        bits[h >> 3] |= 1 << (h & 7)
+    return bytes(bits)
+
+
+class TrigramIndex:
+    ''' Keeps the bloom filter of the trigrams of every chunk of the
+        LineStore of a buffer (LineStore.blooms), to skip the chunks
+        that can not match a pattern. Blooms are built by a background
+        worker thread, for the chunks that do not have one yet; edits
+        clear the ones of the chunks they touch '''
+    def __init__(self, buffer):
+        self.b = buffer
+        self.job = None
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = None
+
+    def busy(self):
+        ''' Wether there are blooms left to build '''
+        return self.job is not None or None in self.b.lines.blooms
+
+    def pump(self):
+        ''' Store the blooms the worker built, if the buffer did not
+            change meanwhile, and give it more chunks '''
+        lines = self.b.lines
+        while True:
+            try:
+                job, blooms = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if job is not self.job:
+                continue
+            self.job = None
+            version, chunks = job
+            if version != (self.b.version, len(lines)):
+                continue
+            for c, b in blooms:
+                lines.blooms[c] = b
+        if self.job is None:
+            self.submit()
+
+    def submit(self):
+        ''' Give the worker the text of the next chunks without bloom '''
+        lines = self.b.lines
+        chunks = []
+        for c in range(len(lines.chunks)):
+            if lines.blooms[c] is None:
+                chunks.append((c, lines.chunk_text(c)))
+                if len(chunks) == INDEX_CHUNKS:
+                    break
+        if len(chunks) == 0:
+            return
+        self.job = ((self.b.version, len(lines)), chunks)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+        self.jobs.put(self.job)
+
+    def work(self):
+        ''' Background worker, building the blooms of the jobs queued '''
+        while True:
+            job = self.jobs.get()
+            self.results.put((job, [(c, bloom(text)) for c, text in job[1]]))
+
+    def candidates(self, pattern):
+        ''' Return a list telling for every chunk wether pattern may
+            match in it, or None if all of them have to be searched '''
+        hashes = trigram_hashes(pattern)
+        if len(hashes) == 0:
+            return None
+        found = []
+        for b in self.b.lines.blooms:
+            if b is None:
+                found.append(True)
+                continue
+            for h in hashes:
+                if not b[h >> 3] & (1 << (h & 7)):
+                    found.append(False)
+                    break
+            else:
+                found.append(True)
+        return found
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+ undo - journal of the changes made to a buffer, to undo and redo them
+
+ Copyright (C) 2012, 2013 Pablo Martin <pablo@odkq.com>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Undo steps kept, the oldest ones are forgotten
+UNDO_LEVELS = 1000
+
+# Characters of text kept in the steps, for all of them
+UNDO_SIZE = 32 * 1024 * 1024
+
+
+class Journal:
+    ''' Changes made to the lines of a buffer, as a list of steps that
+        can be undone and redone. A step is what one command (or one
+        insert session) changed, and holds a list of deltas:
+
+        [y, x, old, new]     the text old at column x of line y was
+                             replaced with new
+        [y, None, old, new]  the lines from y on with the texts in the
+                             list old were replaced with the ones in
+                             the list new
+
+        Only the text of lines is kept, as it goes to the file, and
+        put back in the LineStore as raw entries. Typing (or deleting)
+        characters one after another grows the last delta instead of
+        adding one per character '''
+    def __init__(self, buffer, levels=UNDO_LEVELS, size=UNDO_SIZE):
+        self.b = buffer
+        self.levels = levels
+        self.size = size
+        self.undos = []
+        self.redos = []
+        # Step being recorded, see seal()
+        self.step = None
+        # Characters held by all the steps
+        self.used = 0
+
+    def texts(self, since, to):
+        ''' Texts of lines since..to (not included), to give to lines().
+            Like all the line numbers given to the journal, since can be
+            negative, counting from the end '''
+        lines = self.b.lines
+        if since < 0:
+            since += len(lines)
+            to += len(lines)
+        return [lines.get_file_text(n) for n in range(since, to)]
+
+    def record(self, delta, size):
+        ''' Add delta to the step being recorded, starting it if needed '''
+        if self.step is None:
+            # The cursor to go back to when undoing it
+            self.step = [(self.b.cursor.y, self.b.cursor.x), [], 0]
+        self.step[1].append(delta)
+        self.grow(size)
+
+    def grow(self, size):
+        self.step[2] += size
+        self.used += size
+
+    def span(self, y, x, old, new):
+        ''' Record that the text old at column x of line y was replaced
+            with new '''
+        if y < 0:
+            y += len(self.b.lines)
+        if self.step is not None and self.step[1]:
+            last = self.step[1][-1]
+            if last[0] == y and last[1] is not None:
+                if old == '' and last[2] == '' and x == last[1] + len(last[3]):
+                    # Typing on
+                    last[3] += new
+                    self.grow(len(new))
+                    return
+                if new == '' and last[3] == '':
+                    if x == last[1]:
+                        # Deleting forward
+                        last[2] += old
+                        self.grow(len(old))
+                        return
+                    if x + len(old) == last[1]:
+                        # Deleting backward
+                        last[1] = x
+                        last[2] = old + last[2]
+                        self.grow(len(old))
+                        return
+                if (new == '' and last[2] == '' and
+                        x + len(old) == last[1] + len(last[3]) and
+                        last[3].endswith(old)):
+                    # Deleting what was just typed
+                    last[3] = last[3][:len(last[3]) - len(old)]
+                    self.grow(-len(old))
+                    if last[3] == '':
+                        self.step[1].pop()
+                    return
+        self.record([y, x, old, new], len(old) + len(new))
+
+    def lines(self, y, old, count):
+        ''' Record that the lines from y on with the texts in old were
+            replaced with the count lines there now '''
+        if y < 0:
+            y += len(self.b.lines) - count + len(old)
+        new = self.texts(y, y + count)
+        self.record([y, None, old, new],
+                    sum(map(len, old)) + sum(map(len, new)))
+
+    def seal(self):
+        ''' Finish the step being recorded, if it changed anything, and
+            forget the oldest ones beyond the limits '''
+        step = self.step
+        self.step = None
+        if step is None or len(step[1]) == 0:
+            return
+        self.undos.append(step)
+        for redo in self.redos:
+            self.used -= redo[2]
+        self.redos = []
+        while len(self.undos) > 1 and (len(self.undos) > self.levels or
+                                       self.used > self.size):
+            self.used -= self.undos.pop(0)[2]
+
+    def apply(self, delta, undo):
+        ''' Make (or undo) the change of delta. Return the lines touched '''
+        lines = self.b.lines
+        y, x, old, new = delta
+        if undo:
+            old, new = new, old
+        if x is None:
+            del lines[y:y + len(old)]
+            lines.insert_many(y, new)
+            return y, y + len(new), len(new) != len(old)
+        lines[y].splice(x, x + len(old), new)
+        return y, y + 1, False
+
+    def replay(self, step, undo):
+        ''' Undo or redo all the deltas of step, and rehighlight '''
+        deltas = step[1]
+        since = to = None
+        moved = False
+        for delta in (reversed(deltas) if undo else deltas):
+            first, last, shifted = self.apply(delta, undo)
+            since = first if since is None else min(since, first)
+            to = last if to is None else max(to, last)
+            moved = moved or shifted
+        self.b.rescan(since, None if moved else to)
+        if undo:
+            y, x = step[0]
+        else:
+            y, x = deltas[0][0], deltas[0][1] or 0
+        self.b.cursor.y = min(y, max(len(self.b.lines) - 1, 0))
+        self.b.cursor.x = x
+        self.b.cursor.max = x
+        self.b.cursor_and_viewport_adjustement()
+
+    def undo(self):
+        ''' Undo the last step. Return False if there was none '''
+        self.seal()
+        if len(self.undos) == 0:
+            return False
+        step = self.undos.pop()
+        self.replay(step, True)
+        self.redos.append(step)
+        return True
+
+    def redo(self):
+        ''' Redo the last step undone. Return False if there was none '''
+        self.seal()
+        if len(self.redos) == 0:
+            return False
+        step = self.redos.pop()
+        self.replay(step, False)
+        self.undos.append(step)
+        return True